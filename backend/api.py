@@ -1,30 +1,53 @@
+import asyncio
+import csv
 import datetime
-import re
+import json
+import logging
+from typing import Optional
 
-from fastapi import Depends, FastAPI, HTTPException, status
+from fastapi import (Depends, FastAPI, File, HTTPException, Query, Request,
+                     Response, UploadFile, status)
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi_mail import ConnectionConfig, FastMail, MessageSchema
 from passlib.context import CryptContext
 from pydantic import BaseModel, EmailStr
-from sqlalchemy import and_, desc, or_, select
+from sqlalchemy import and_, desc, false, or_, select, true
 from sqlalchemy.sql import func
 
-from auth import (confirm_token, create_access_token, get_current_user,
-                  get_current_user_route)
-from func import insert_message
-from gtranslate import translate_text
-from models import database, messages, offers, passengers, routes, users
-from pydmodels import (CreateRoute, DeleteRoute, PassengerData, Register,
-                       RemovePassenger, Route, Search, SetPassengers,
-                       UpdateRoute, User)
+from auth import (confirm_token, create_access_token, get_admin_user,
+                  get_auth_context, get_current_user, get_current_user_route,
+                  get_partner_user)
+from etag import hashed_response, not_modified, versions
+from export import export_query, stream_export
+from func import (book_stops, insert_message, insert_offers, insert_stops,
+                  new_route_id, retention_loop, update_passenger_stops)
+from gazetteer import gazetteer
+from ingest import MAX_ROWS, copy_routes, parse_rows, validate_rows
+from logs import new_request_id, request_id, setup_logging
+from matching import matcher
+from models import (database, database_monitor, messages, passengers, reads,
+                    replica_monitor, route_stops, routes, users)
+from pool import PoolTimeoutError
+from pydmodels import (BulkOffer, CreateRoute, DeleteRoute, PassengerData,
+                       Register, RemovePassenger, Route, RouteId, Search,
+                       SetPassengers, UpdatePassenger, UpdateRoute, User)
+from queries import (active_booking, booked_seats, dashboard, my_seats,
+                     passengers_by_route, route_by_id, route_offers,
+                     search_city_drivers, search_city_passengers,
+                     search_drivers, search_passengers, search_segment_drivers,
+                     search_segment_passengers, unread_count)
 from settings import Settings, timezone
-from webs import manager, ws
+from suggest import city_index
+from webs import ws
 
 api = FastAPI(redoc_url=None)
 api.include_router(ws)
 
 settings = Settings()
+log_listener = setup_logging()
+logger = logging.getLogger(__name__)
 
 
 mail_config = ConnectionConfig(
@@ -53,15 +76,42 @@ api.add_middleware(
 )
 
 
+@api.middleware("http")
+async def request_context(request: Request, call_next):
+    rid = request.headers.get("x-request-id") or new_request_id()
+    request_id.set(rid)
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = rid
+    return response
+
+
+@api.exception_handler(PoolTimeoutError)
+async def pool_timeout(request: Request, exc: PoolTimeoutError):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Сервер перевантажений, спробуйте пізніше"}
+    )
+
 
 @api.on_event("startup")
 async def startup():
     await database.connect()
+    await database_monitor.start()
+    await reads.start()
+    await matcher.start()
+    await city_index.start()
+    api.state.retention = asyncio.create_task(retention_loop())
 
 
 @api.on_event("shutdown")
 async def shutdown():
+    api.state.retention.cancel()
+    await city_index.stop()
+    await matcher.stop()
+    await reads.stop()
+    await database_monitor.stop()
     await database.disconnect()
+    log_listener.stop()
 
 
 @api.get("/")
@@ -69,6 +119,11 @@ async def main():
     return {"message": "FromTo"}
 
 
+@api.get("/pool-stats")
+async def pool_stats(current_user: User = Depends(get_admin_user)):
+    return [monitor.stats() for monitor in (database_monitor, replica_monitor) if monitor is not None]
+
+
 @api.get("/user")
 async def user(current_user: User = Depends(get_current_user)):
     return current_user
@@ -153,34 +208,78 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
 
 
 @api.post("/create-route")
-async def create_route(route: CreateRoute, current_user: User = Depends(get_current_user)):
-    import uuid
-    translate_route = translate_text("uk", route.name.lower().title())
-    date_and_time = datetime.datetime.combine(route.date, route.time)
-    query = select(routes.c.id).where(and_(
-            routes.c.user_id == current_user["id"],
-            routes.c.status != 1,
-            routes.c.datetime >= timezone()
-    ))
-    result = await database.fetch_one(query)
-    if result:
+async def create_route(route: CreateRoute, current_user: User = Depends(get_current_user), current_user_route: User = Depends(get_current_user_route)):
+    if current_user_route["id"]:
         raise HTTPException(401, detail="У вас вже є дійсний маршрут")
-    await database.execute(
-        routes.insert().values(
-            id=str(uuid.uuid4()),
-            route=translate_route["translatedText"],
-            datetime=date_and_time,
-            description=route.description,
-            car=route.vehicle,
-            seats=route.seats,
-            price=route.price,
-            status=0,
-            user_id=current_user["id"]
+    cities = gazetteer.cities(route.name)
+    route_name = " - ".join(cities)
+    date_and_time = datetime.datetime.combine(route.date, route.time)
+    route_id = new_route_id()
+    async with database.transaction():
+        await database.execute(
+            routes.insert().values(
+                id=route_id,
+                route=route_name,
+                datetime=date_and_time,
+                description=route.description,
+                car=route.vehicle,
+                seats=route.seats,
+                price=route.price,
+                status=0,
+                user_id=current_user["id"]
+            )
         )
-    )
+        await insert_stops(route_id, [gazetteer.key(city) for city in cities])
+    reads.mark_write(current_user["id"])
+    city_index.add_route(route_id, route_name, date_and_time)
+    await matcher.route_changed({
+        "id": route_id,
+        "user_id": current_user["id"],
+        "route": route_name,
+        "datetime": date_and_time,
+        "seats": route.seats,
+        "car": route.vehicle,
+    })
     return {"message": "Маршрут створено"}
 
 
+@api.post("/routes/import")
+async def import_routes(file: UploadFile = File(...), current_user: User = Depends(get_partner_user)):
+    if file.filename.endswith((".ndjson", ".jsonl")) or "ndjson" in (file.content_type or ""):
+        fmt = "ndjson"
+    else:
+        fmt = "csv"
+    try:
+        rows = parse_rows(await file.read(), fmt)
+    except UnicodeDecodeError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Файл має бути у кодуванні UTF-8"
+        )
+    except csv.Error:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Невірний формат файлу"
+        )
+    if len(rows) > MAX_ROWS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Не більше {MAX_ROWS} маршрутів за раз"
+        )
+    valid, errors = validate_rows(rows)
+    created = await copy_routes(current_user["id"], valid) if valid else []
+    reads.mark_write(current_user["id"])
+    for route in created:
+        city_index.add_route(route["id"], route["route"], route["datetime"])
+        await matcher.route_changed({key: route[key] for key in ("id", "user_id", "route", "datetime", "seats", "car")})
+    return {"message": "Маршрути завантажено", "imported": len(created), "failed": len(errors), "errors": errors}
+
+
+@api.get("/cities/suggest")
+async def suggest_cities(q: str, limit: int = Query(10, ge=1, le=50)):
+    return city_index.suggest(q, limit)
+
+
 @api.post("/search")
 async def search(search: Search):
     if search.datetime > timezone().date():
@@ -189,37 +288,40 @@ async def search(search: Search):
         time = timezone().strftime("%H:%M:00")
         timef_to_time = datetime.datetime.strptime(time, "%H:%M:00").time()
     date = datetime.datetime.combine(search.datetime, timef_to_time)
-    
-    # text = translate_text("uk", search.route.title())
-
-    # cities = re.split(r"[.|,|-| ]", text["translatedText"].lower().title().replace(", ", ","))
-    cities = re.split(r"[.|,|-| ]", search.route.lower().title())
-    cities_inline = "%".join(cities).replace(" ", "")
 
-    if search.driver:
-        is_driver = routes.c.car == ""
+    cities = gazetteer.stops(search.route)
+    if len(cities) >= 2:
+        # any route passing through the first city and later the last one
+        if search.driver:
+            query = search_segment_passengers
+        else:
+            query = search_segment_drivers
+        return await reads.fetch_all(query, {
+            "from_city": cities[0],
+            "to_city": cities[-1],
+            "seats": search.seats,
+            "date": date,
+            "limit": search.limit
+        })
+
+    values = {"seats": search.seats, "date": date, "limit": search.limit}
+    if cities:
+        query = search_city_passengers if search.driver else search_city_drivers
+        values["city"] = cities[0]
     else:
-        is_driver = routes.c.car != ""
-        
-    query = select(routes, users.c.name, users.c.rating_user)\
-        .select_from(routes.join(users))\
-        .where(and_(
-            routes.c.route.like(f"%{cities_inline}%"),
-            routes.c.seats >= search.seats,
-            routes.c.status == 0,
-            routes.c.datetime >= date,
-            is_driver
-    ))
-    result = await database.fetch_all(query)
-    return result
+        query = search_passengers if search.driver else search_drivers
+    return await reads.fetch_all(query, values)
 
 
 @api.get("/route/{id}")
-async def route(id: str):
-    sum = select(func.sum(passengers.c.seats)).where(and_(passengers.c.route_id == id, passengers.c.description.like('')))
-    query = select(routes, users.c.name, users.c.rating_user).select_from(routes.join(users)).where(routes.c.id == id)
-    query_result = await database.fetch_one(query)
-    result_sum = await database.fetch_val(sum)
+async def route(id: RouteId, request: Request, response: Response):
+    # versioned reads go to the primary, a lagging replica would cache stale
+    # data under the new ETag
+    cached = not_modified(request, response, versions.etag(("route", id)))
+    if cached:
+        return cached
+    query_result = await route_by_id.fetch_one(database, id=id)
+    result_sum = await booked_seats.fetch_val(database, route_id=id)
     if query_result is not None:
         query_result = dict(query_result)
         query_result.update({"sum": result_sum})
@@ -229,48 +331,65 @@ async def route(id: str):
 @api.post("/set-passengers")
 async def set_passengers(route: SetPassengers, current_user: User = Depends(get_current_user)):
     date = datetime.datetime.today()
-    query = select(passengers.c.id).select_from(passengers.join(routes)).where(
-        and_(passengers.c.user_id == current_user["id"], routes.c.datetime > date, passengers.c.description == '')
-    )
-    result = await database.fetch_one(query)
+    result = await active_booking.fetch_one(database, user_id=current_user["id"], now=date)
     if result:
         raise HTTPException(
             status_code=status.HTTP_406_NOT_ACCEPTABLE,
             detail="У вас вже є заброньоване місце"
         )
-    await database.execute(
-        passengers.insert().values(
-            route_id=route.router,
-            user_id=current_user["id"],
-            seats=route.seats,
-            description=route.description,
+    from_stop, to_stop = None, None
+    if route.from_city or route.to_city:
+        from_stop, to_stop = await find_segment(route.router, route.from_city, route.to_city)
+    async with database.transaction():
+        await database.execute(
+            passengers.insert().values(
+                route_id=route.router,
+                user_id=current_user["id"],
+                seats=route.seats,
+                description=route.description,
+                from_stop=from_stop,
+                to_stop=to_stop,
+            )
         )
-    )
+        await book_stops(route.router, route.seats, from_stop, to_stop)
+    reads.mark_write(current_user["id"])
+    versions.bump(("route", route.router))
+    await matcher.booked_changed(route.router)
     p_phone = current_user["phone"]
     p_name = current_user["name"]
-    msg = messages.insert().values(
-        read=False,
-        route_id=route.router,
-        user_id=route.owner_id,
-        text=f"Пасажир {p_name}, {p_phone} долучився до маршруту '{route.name}' {route.datetime}.",
-        created=datetime.datetime.strptime(datetime.datetime.strftime(timezone(), "%d.%m.%y %H:%M"), "%d.%m.%y %H:%M")
-    )
-    await database.execute(msg)
+    text_msg = f"Пасажир {p_name}, {p_phone} долучився до маршруту '{route.name}' {route.datetime}."
+    created_msg = datetime.datetime.strptime(datetime.datetime.strftime(timezone(), "%d.%m.%y %H:%M"), "%d.%m.%y %H:%M")
+    await insert_message(route.router, route.owner_id, text_msg, created_msg)
     return {"message": "Ви долучились до маршруту"}
 
 
+async def find_segment(route_id: str, from_city: Optional[str], to_city: Optional[str]):
+    stops = await database.fetch_all(
+        select(route_stops.c.position, route_stops.c.city)
+            .where(route_stops.c.route_id == route_id)
+            .order_by(route_stops.c.position)
+    )
+    start = stops[0]["position"] if stops and not from_city else None
+    end = stops[-1]["position"] if stops and not to_city else None
+    from_city = gazetteer.normalize(from_city) if from_city else None
+    to_city = gazetteer.normalize(to_city) if to_city else None
+    for stop in stops:
+        if start is None and stop["city"] == from_city:
+            start = stop["position"]
+        elif start is not None and stop["position"] > start and stop["city"] == to_city:
+            end = stop["position"]
+            break
+    if start is None or end is None or end <= start:
+        raise HTTPException(
+            status_code=status.HTTP_406_NOT_ACCEPTABLE,
+            detail="Маршрут не проходить через ці міста"
+        )
+    return start, end
+
+
 @api.get("/my-seats")
 async def user_routes(current_user: User = Depends(get_current_user)):
-    query = select(routes, passengers.c.id.label("p_id"), passengers.c.seats.label("booking_seats"),
-                users.c.id, users.c.name, users.c.phone)\
-                    .select_from(routes.join(passengers).join(users))\
-                        .where(and_(
-                            passengers.c.user_id == current_user["id"],
-                            routes.c.datetime >= timezone(),
-                            routes.c.status == 0,
-                            passengers.c.description.like("")
-                        )).order_by(desc(routes.c.datetime))
-    result = await database.fetch_one(query)
+    result = await my_seats.fetch_one(database, user_id=current_user["id"], now=timezone())
     if result is not None:
         result = dict(result)
         return result
@@ -278,23 +397,35 @@ async def user_routes(current_user: User = Depends(get_current_user)):
 
 
 @api.get("/my-routes")
-async def driver_routes(current_user: User = Depends(get_current_user), current_user_route: User = Depends(get_current_user_route)):
-    query_seats = select(func.sum(passengers.c.seats)).where(and_(
-        passengers.c.route_id == current_user_route["id"],
-        passengers.c.description.like("")
-    ))
-    query = select(routes.c.id, routes.c.route, routes.c.car, routes.c.seats, routes.c.datetime, routes.c.description).where(and_(
-        routes.c.user_id == current_user["id"],
-        routes.c.datetime >= timezone(),
-        routes.c.status == 0
-    ))
-    seats = await database.fetch_val(query_seats)
-    route = await database.fetch_one(query)
-    if route is not None:
-        route = dict(route)
-        route.update({"sum": seats})
-        return route
-    return {}
+async def driver_routes(request: Request, response: Response, current_user_route: User = Depends(get_current_user_route)):
+    if current_user_route["id"] is None:
+        return {}
+    cached = not_modified(request, response, versions.etag(("route", current_user_route["id"])))
+    if cached:
+        return cached
+    seats = await booked_seats.fetch_val(database, route_id=current_user_route["id"])
+    route = {key: current_user_route[key] for key in ("id", "route", "car", "seats", "datetime", "description")}
+    route.update({"sum": seats})
+    return route
+
+
+@api.get("/dashboard")
+async def driver_dashboard(request: Request, context: dict = Depends(get_auth_context)):
+    # /user, /my-routes, /route/{id}/passengers, /offers/{id} and
+    # /number-messages for the active route in one round trip
+    current_user, current_user_route = context["user"], context["route"]
+    row = await dashboard.fetch_one(database, user_id=current_user["id"], route_id=current_user_route["id"])
+    route = {}
+    if current_user_route["id"] is not None:
+        route = {key: current_user_route[key] for key in ("id", "route", "car", "seats", "datetime", "description")}
+        route.update({"sum": row["sum"]})
+    return hashed_response(request, {
+        "user": {key: current_user[key] for key in ("id", "name", "email", "phone", "rating_user")},
+        "route": route,
+        "passengers": json.loads(row["passengers"]),
+        "offers": json.loads(row["offers"]),
+        "number_messages": row["number_messages"],
+    })
 
 
 @api.get("/routes-history")
@@ -307,7 +438,7 @@ async def routes_history(current_user: User = Depends(get_current_user)):
                                 routes.c.status == 1
                             )
                         )).order_by(desc(routes.c.datetime))
-    result = await database.fetch_all(query)
+    result = await reads.fetch_all(query, user_id=current_user["id"])
     return result
 
 
@@ -329,9 +460,13 @@ async def user_routes_history(current_user: User = Depends(get_current_user)):
 
 @api.post("/delete-route")
 async def delete_route(route: DeleteRoute, current_user: User = Depends(get_current_user)):
+    await update_passenger_stops(route.pass_id)
     await database.execute(
         passengers.update().where(passengers.c.id == route.pass_id).values(description="Ви відмінили бронь")
     )
+    reads.mark_write(current_user["id"])
+    versions.bump(("route", route.route_id))
+    await matcher.booked_changed(route.route_id)
     p_name = current_user["name"]
     p_phone = current_user["phone"]
     text_msg = f"Пасажир {p_name}, {p_phone} відмінив бронювання '{route.route_name}', {route.datetime}"
@@ -352,26 +487,20 @@ async def get_route(route: Route):
 
 
 @api.post("/update-route")
-async def update_route(data: UpdateRoute, current_user: User = Depends(get_current_user)):
-    query = f"""
-        UPDATE passengers SET seats = {data.seats}
-        WHERE id = {data.id}
-    """
-    await database.execute(query)
+async def update_route(data: UpdatePassenger, current_user: User = Depends(get_current_user)):
+    await update_passenger_stops(data.id, data.seats)
+    query = passengers.update().where(passengers.c.id == data.id).values(seats=data.seats)\
+        .returning(passengers.c.route_id)
+    route_id = await database.fetch_val(query)
+    if route_id is not None:
+        versions.bump(("route", route_id))
+        await matcher.booked_changed(route_id)
     return {"message": "Маршрут змінено"}
 
 
 @api.get("/check-active-route")
-async def check_active_route(current_user: User = Depends(get_current_user)):
-    query = select(routes.c.id).where(
-        and_(
-            routes.c.user_id == current_user["id"],
-            routes.c.status != 1,
-            routes.c.datetime >= timezone()
-        )
-    )
-    result = await database.fetch_val(query)
-    if result:
+async def check_active_route(current_user_route: User = Depends(get_current_user_route)):
+    if current_user_route["id"]:
         return {"message": "У вас вже є дійсний маршрут"}
 
 
@@ -379,6 +508,10 @@ async def check_active_route(current_user: User = Depends(get_current_user)):
 async def change_active_route(route: Route, current_user: User = Depends(get_current_user)):
     query = routes.update().where(routes.c.id == route.id).values(status=1)
     await database.execute(query)
+    reads.mark_write(current_user["id"])
+    matcher.remove(route.id)
+    city_index.remove_route(route.id)
+    versions.bump(("route", route.id))
     ids = select(passengers.c.user_id).where(and_(
         passengers.c.route_id == route.id,
         passengers.c.description.like('')
@@ -394,7 +527,6 @@ async def change_active_route(route: Route, current_user: User = Depends(get_cur
     created_msg = datetime.datetime.strptime(datetime.datetime.strftime(timezone(), "%d.%m.%y %H:%M"), "%d.%m.%y %H:%M")
     for i in result_ids:
         await insert_message(route.id, dict(i).get("user_id"), text_msg, created_msg)
-    await manager.send_number_of_message_all_users_by_route(result_ids)
     return {"message": "Ви відмінили маршрут"}
 
 
@@ -410,24 +542,25 @@ async def get_confirm_email(token: str):
 
 
 @api.get("/route/{id}/passengers")
-async def route_passengers(id: str, current_user: User = Depends(get_current_user)):
-    query = (
-        select(routes.c.datetime, passengers.c.id, passengers.c.route_id, passengers.c.seats, passengers.c.description, users.c.id.label("user_id"), users.c.name, users.c.email, users.c.phone)\
-            .select_from(routes.join(passengers).join(users))\
-                .where(and_(passengers.c.route_id == id, passengers.c.description == ''))
-    )
-    result = await database.fetch_all(query)
+async def route_passengers(id: RouteId, request: Request, response: Response, current_user: User = Depends(get_current_user)):
+    cached = not_modified(request, response, versions.etag(("route", id)))
+    if cached:
+        return cached
+    result = await passengers_by_route.fetch_all(database, route_id=id)
     if not result:
         query = select(passengers.c.id, passengers.c.route_id, passengers.c.seats, users.c.id.label("user_id"), passengers.c.description, users.c.name, users.c.email, users.c.phone)\
                         .select_from(passengers.join(users))\
                             .where(and_(passengers.c.route_id == id))
         result = await database.fetch_all(query)
-    print(query)
     return result
 
 
 @api.get("/users/{id}")
-async def get_user(id: int, current_user: User = Depends(get_current_user)):
+async def get_user(id: int, request: Request, response: Response, current_user: User = Depends(get_current_user)):
+    # name and email never change through the API
+    cached = not_modified(request, response, versions.etag(("user", id)))
+    if cached:
+        return cached
     query = (
         select(users.c.name, users.c.email)\
             .where(users.c.id == id)
@@ -438,8 +571,11 @@ async def get_user(id: int, current_user: User = Depends(get_current_user)):
 
 @api.post("/route/remove-passenger")
 async def remove_passenger(data: RemovePassenger, current_user: User = Depends(get_current_user)):
+    await update_passenger_stops(data.pass_id)
     query = passengers.update().where(passengers.c.id == data.pass_id).values(description="Водій вилучив вас з маршруту")
     await database.execute(query)
+    versions.bump(("route", data.route_id))
+    await matcher.booked_changed(data.route_id)
     query_route = routes.select().where(routes.c.id == data.route_id)
     route = dict(await database.fetch_one(query_route))
     
@@ -455,111 +591,126 @@ async def remove_passenger(data: RemovePassenger, current_user: User = Depends(g
 
 @api.get("/number-messages")
 async def number_message(current_user: User = Depends(get_current_user)):
-    query = select(func.count(messages.c.id)).where(and_(
-        messages.c.user_id == current_user["id"],
-        messages.c.read == False
-    ))
-    number_messages = await database.fetch_val(query)
+    number_messages = await unread_count.fetch_val(database, user_id=current_user["id"])
     return number_messages
 
 
+# the read flag of a message is derived from users.last_read_message_id
+message_columns = [c for c in messages.c if c.name != "read"]
+
+
 @api.get("/messages-history")
 async def messages_history(current_user: User = Depends(get_current_user)):
-    query = select(messages).where(and_(
+    query = select(*message_columns, true().label("read")).where(and_(
         messages.c.user_id == current_user["id"],
-        messages.c.read == True
-    )).order_by(desc(messages.c.created))
-    return await database.fetch_all(query)
+        messages.c.id <= (current_user["last_read_message_id"] or 0)
+    )).order_by(desc(messages.c.id))
+    return await reads.fetch_all(query, user_id=current_user["id"])
 
 
 @api.get("/get-message")
 async def get_message(current_user: User = Depends(get_current_user)):
-    query = select(messages).where(and_(
+    query = select(*message_columns, false().label("read")).where(and_(
         messages.c.user_id == current_user["id"],
-        messages.c.read == False
-    ))
+        messages.c.id > (current_user["last_read_message_id"] or 0)
+    )).order_by(messages.c.id)
     result = await database.fetch_all(query)
     return result
 
 
 @api.patch("/change-read-message")
 async def change_read_message(current_user: User = Depends(get_current_user)):
-    query = messages.update().where(and_(
-        messages.c.user_id == current_user["id"],
-        messages.c.read == False
-    )).values(read=True)
+    # one row: move the user's watermark to their newest message
+    last_id = select(func.coalesce(func.max(messages.c.id), 0))\
+        .where(messages.c.user_id == current_user["id"]).scalar_subquery()
+    query = users.update().where(users.c.id == current_user["id"]).values(
+        last_read_message_id=func.greatest(users.c.last_read_message_id, last_id),
+        last_read_at=timezone()
+    )
     await database.execute(query)
+    reads.mark_write(current_user["id"])
     return {"message": "OK"}
 
 
 @api.post("/offer")
 async def offer(data: PassengerData, current_user_route: User = Depends(get_current_user_route)):
-    query = select(routes).where(
-        routes.c.id == current_user_route["id"]
-    )
-    result = await database.fetch_val(query)
-    if not result:
+    if not current_user_route["id"]:
         raise HTTPException(
             status_code=status.HTTP_406_NOT_ACCEPTABLE,
             detail="У вас немає маршруту"
         )
-    query = select(offers).where(
-        and_(
-            offers.c.route_d_id == current_user_route["id"],
-            offers.c.route_p_id == data.route_id
-        )
-    )
-    result = await database.fetch_val(query)
-    if result:
+    text_msg, created_msg = offer_message(current_user_route)
+    user_ids = await insert_offers(current_user_route["id"], [data.route_id], text_msg, created_msg)
+    request = select(routes.c.id).where(and_(routes.c.id == data.route_id, routes.c.car == "", routes.c.status == 0))
+    if not user_ids and await database.fetch_val(request) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Маршрут не знайдено")
+    if not user_ids:
         raise HTTPException(
             status_code=status.HTTP_406_NOT_ACCEPTABLE,
             detail="Пропозиція вже відправлена"
         )
-    query = offers.insert().values(
-        route_p_id=data.route_id,
-        route_d_id=current_user_route["id"],
-        user_id=data.user_id,
-        description="Вам запропонували маршрут",
-    )
-    await database.execute(query)
-    
+    return {"message": "Пропозиція відправлена"}
+
+
+@api.post("/offer/bulk")
+async def bulk_offer(data: BulkOffer, current_user_route: User = Depends(get_current_user_route)):
+    if not current_user_route["id"]:
+        raise HTTPException(
+            status_code=status.HTTP_406_NOT_ACCEPTABLE,
+            detail="У вас немає маршруту"
+        )
+    text_msg, created_msg = offer_message(current_user_route)
+    user_ids = await insert_offers(current_user_route["id"], [route.route_id for route in data.routes], text_msg, created_msg)
+    return {"message": "Пропозиції відправлені", "sent": len(user_ids), "skipped": len(data.routes) - len(user_ids)}
+
+
+def offer_message(current_user_route: dict):
     route_name = current_user_route["route"]
     route_datetime = current_user_route["datetime"]
     route_datetime_format = datetime.datetime.strftime(route_datetime, "%d.%m.%y %H:%M")
     text_msg = f"Вам відправлена пропозиція маршруту '{route_name}' на {route_datetime_format}."
     created_msg = datetime.datetime.strptime(datetime.datetime.strftime(timezone(), "%d.%m.%y %H:%M"), "%d.%m.%y %H:%M")
-
-    await insert_message(current_user_route["id"], data.user_id, text_msg, created_msg)
-    await manager.send_number_messages_by_user(data.user_id)
-    return {"message": "Пропозиція відправлена"}
+    return text_msg, created_msg
 
 
 @api.get("/offers/{id}")
-async def get_offers(id: str, current_user: User = Depends(get_current_user)):
-    query = select(offers.c.id.label("offer"), routes.c.route, routes.c.id, routes.c.seats, routes.c.datetime, routes.c.status)\
-        .select_from(offers.join(routes)).where(
-        and_(
-            offers.c.route_p_id == id,
-            offers.c.user_id == current_user["id"],
-        )
-    )
-    result = await database.fetch_all(query)
-    return result
+async def get_offers(id: RouteId, request: Request, current_user: User = Depends(get_current_user)):
+    result = await reads.fetch_all(route_offers, {"route_id": id, "user_id": current_user["id"]}, user_id=current_user["id"])
+    return hashed_response(request, result)
 
 
 @api.post("/update-seats")
 async def update_seats(route: UpdateRoute, current_user: User = Depends(get_current_user)):
-    query = select(func.sum(passengers.c.seats)).where(and_(
-        passengers.c.route_id == route.id,
-        passengers.c.description.like("")
-    ))
-    sum_free_seats = await database.fetch_val(query)
+    sum_free_seats = await booked_seats.fetch_val(database, route_id=route.id)
     if not sum_free_seats: sum_free_seats = 0
     new_route_seats = routes.update().where(routes.c.id == route.id).values(seats=sum_free_seats + route.seats, description=route.desc)
     await database.execute(new_route_seats)
+    reads.mark_write(current_user["id"])
+    versions.bump(("route", route.id))
+    await matcher.seats_changed(route.id, sum_free_seats + route.seats)
     return {"message": "Дані оновлено"}
 
 
+@api.get("/admin/export/{table}")
+async def export(
+    table: str,
+    fmt: str = Query("csv", alias="format"),
+    date_from: Optional[datetime.date] = None,
+    date_to: Optional[datetime.date] = None,
+    status: Optional[int] = None,
+    current_user: User = Depends(get_admin_user)
+):
+    if table not in ("routes", "passengers", "messages") or fmt not in ("csv", "ndjson"):
+        raise HTTPException(status_code=404, detail="Невідомий формат експорту")
+    query, columns = export_query(table, date_from, date_to, status)
+    # the replica when it is up, so exports never compete with live traffic
+    return StreamingResponse(
+        stream_export(reads.reader(), query, columns, fmt),
+        media_type="text/csv" if fmt == "csv" else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{table}.{fmt}"'}
+    )
+
+
 class SupportData(BaseModel):
     name: str
     email: EmailStr
@@ -584,7 +735,7 @@ class SupportData(BaseModel):
 
 
 class Rating(BaseModel):
-    routeId: str
+    routeId: RouteId
     driverId: str
     rating: str
     comment: str
@@ -592,7 +743,7 @@ class Rating(BaseModel):
 
 @api.post("/route/rating")
 async def rating_route(data: Rating, current_user: User = Depends(get_current_user)):
-    print(data)
+    logger.info("route rated", extra={"route_id": data.routeId, "driver_id": data.driverId, "rating": data.rating})
     rating_insert = passengers.update().where(and_(
         passengers.c.route_id == data.routeId,
         passengers.c.user_id == current_user["id"]
@@ -625,4 +776,6 @@ async def rating_route(data: Rating, current_user: User = Depends(get_current_us
 
     update_user_rating = users.update().where(users.c.id == int(data.driverId)).values(rating_user=avg_rating_user)
     await database.execute(update_user_rating)
+    # the driver rating is part of every route of theirs
+    versions.bump_all()
     return {"message": "Оцінено"}
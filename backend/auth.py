@@ -6,14 +6,17 @@ from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy import and_
 
 from jose import jwt, JWTError
-from models import database, users, routes
-from settings import timezone
+from models import database, reads, users, routes
+from queries import user_with_active_route
+from settings import Settings, timezone
 
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 120
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
+settings = Settings()
+
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.datetime.utcnow() + datetime.timedelta(hours=3) + datetime.timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -22,7 +25,10 @@ def create_access_token(data: dict):
     return encoded_jwt
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
+async def get_auth_context(token: str = Depends(oauth2_scheme)):
+    # FastAPI caches dependencies per request, so the token is decoded and the
+    # user with their active route is loaded once however many dependencies
+    # of an endpoint need them
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Для цього необхідно увійти або зареєструватися",
@@ -34,41 +40,45 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
 async def verify_token(token: str, credentials_exception: str):
     try:
         payload = jwt.decode(token, os.environ["SECRET_KEY"], algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        id: int = payload.get("id")
-        user = await database.fetch_one(users.select().where(users.c.id == id))
-        if username is None:
-            raise credentials_exception
-        return user
     except JWTError:
         raise credentials_exception
+    username: str = payload.get("sub")
+    id: int = payload.get("id")
+    if username is None or id is None:
+        raise credentials_exception
+    row = await reads.fetch_one(user_with_active_route, {"id": id, "now": timezone()}, user_id=id)
+    if row is None:
+        raise credentials_exception
+    user = {c.name: row[c.name] for c in users.c}
+    route = {c.name: row["route_" + c.name] for c in routes.c}
+    return {"user": user, "route": route}
 
 
-async def get_route(token: str, credentials_exception: str):
-    try:
-        payload = jwt.decode(token, os.environ["SECRET_KEY"], algorithms=[ALGORITHM])
-        id: int = payload.get("id")
-        query = routes.select().where(and_(
-            routes.c.user_id == id,
-            routes.c.datetime >= timezone(),
-            routes.c.status == 0
-        ))
-        route = await database.fetch_one(query)
-        if route is not None:
-            route = dict(route)
-            return route
-        return {"id": None}
-    except JWTError:
-        raise credentials_exception
+async def get_current_user(context: dict = Depends(get_auth_context)):
+    return context["user"]
 
 
-async def get_current_user_route(token: str = Depends(oauth2_scheme)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Для цього необхідно увійти",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
-    return await get_route(token, credentials_exception)
+async def get_partner_user(context: dict = Depends(get_auth_context)):
+    if context["user"]["id"] not in settings.partner_user_ids:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Лише для перевізників-партнерів",
+        )
+    return context["user"]
+
+
+async def get_admin_user(context: dict = Depends(get_auth_context)):
+    if context["user"]["id"] not in settings.admin_user_ids:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Лише для адміністраторів",
+        )
+    return context["user"]
+
+
+async def get_current_user_route(context: dict = Depends(get_auth_context)):
+    # {"id": None, ...} when the user has no active route
+    return context["route"]
 
 
 async def confirm_token(token: str):
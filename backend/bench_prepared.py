@@ -0,0 +1,82 @@
+"""Compares building and compiling hot queries per request with PreparedQuery.
+
+Run from backend/ with the usual .env: python bench_prepared.py
+Only client side work is measured, no query is sent to the database.
+"""
+import datetime
+import timeit
+
+from sqlalchemy import and_, bindparam, func, select
+
+from models import messages, passengers, route_stops, routes, users
+from prepared import PreparedQuery, dialect
+from queries import (booked_seats, read_watermark, search_city_drivers,
+                     unread_count, user_by_id)
+
+NUMBER = 10000
+date = datetime.datetime.now()
+
+
+def compile_query(query):
+    # what databases does for every ClauseElement it is given
+    compiled = query.compile(dialect=dialect, compile_kwargs={"render_postcompile": True})
+    mapping = {key: "$" + str(i) for i, key in enumerate(compiled.params, start=1)}
+    return compiled.string % mapping, list(compiled.params.values())
+
+
+def per_request_user():
+    return compile_query(users.select().where(users.c.id == 1))
+
+
+def per_request_unread():
+    # one bound value used twice, like the handlers did
+    user_id = bindparam("user_id", 1)
+    return compile_query(select(func.count(messages.c.id)).where(and_(
+        messages.c.user_id == user_id,
+        messages.c.id > read_watermark(user_id)
+    )))
+
+
+def per_request_search():
+    return compile_query(
+        select(routes, users.c.name, users.c.rating_user)
+            .select_from(routes.join(users))
+            .where(and_(
+                routes.c.seats >= 1,
+                routes.c.status == 0,
+                routes.c.datetime >= date,
+                routes.c.car != "",
+                select(route_stops.c.id).where(and_(
+                    route_stops.c.route_id == routes.c.id,
+                    route_stops.c.city == "Київ"
+                )).exists()
+            ))
+            .order_by(routes.c.datetime)
+            .limit(50)
+    )
+
+
+def per_request_sum():
+    return compile_query(select(func.sum(passengers.c.seats)).where(and_(
+        passengers.c.route_id == "route",
+        passengers.c.description.like("")
+    )))
+
+
+def bind(query: PreparedQuery, **values):
+    return query.sql, query.args(values)
+
+
+cases = [
+    ("user by id", per_request_user, lambda: bind(user_by_id, id=1)),
+    ("unread count", per_request_unread, lambda: bind(unread_count, user_id=1)),
+    ("search", per_request_search, lambda: bind(search_city_drivers, city="Київ", seats=1, date=date, limit=50)),
+    ("booked seats", per_request_sum, lambda: bind(booked_seats, route_id="route")),
+]
+
+if __name__ == "__main__":
+    for name, per_request, prepared in cases:
+        assert per_request()[0] == prepared()[0], name
+        before = timeit.timeit(per_request, number=NUMBER) / NUMBER * 1e6
+        after = timeit.timeit(prepared, number=NUMBER) / NUMBER * 1e6
+        print(f"{name:<14} per request {before:8.2f} us   prepared {after:6.2f} us   x{before / after:.0f}")
@@ -0,0 +1,60 @@
+import hashlib
+import json
+import uuid
+from collections import defaultdict
+from typing import Optional
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+
+class Versions:
+    # Version counters bumped by every write that changes what a read endpoint
+    # returns, so an ETag is known before touching the database. The epoch
+    # changes on restart, bump_all() is for writes we can't attribute to a key.
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.generation = 0
+        self.versions = defaultdict(int)
+
+    def bump(self, *keys):
+        for key in keys:
+            self.versions[key] += 1
+
+    def bump_all(self):
+        self.generation += 1
+
+    def etag(self, *keys):
+        parts = [self.epoch, str(self.generation)] + [str(self.versions[key]) for key in keys]
+        return 'W/"' + "-".join(parts) + '"'
+
+
+versions = Versions()
+
+
+def etag_matches(request: Request, etag: str):
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in [tag.strip() for tag in header.split(",")]
+
+
+def not_modified(request: Request, response: Response, etag: str) -> Optional[Response]:
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    for key, value in headers.items():
+        response.headers[key] = value
+    return None
+
+
+def hashed_response(request: Request, data):
+    # for reads without a version counter: still saves the transfer
+    content = jsonable_encoder(data)
+    body = json.dumps(content, ensure_ascii=False, separators=(",", ":"), sort_keys=True)
+    etag = 'W/"' + hashlib.sha1(body.encode()).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(content=content, headers=headers)
@@ -0,0 +1,69 @@
+import csv
+import datetime
+import io
+import json
+from typing import Optional
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import and_, select
+
+from models import messages, passengers, routes
+from prepared import PreparedQuery
+
+BATCH = 1000
+
+
+def export_query(table: str, date_from: Optional[datetime.date], date_to: Optional[datetime.date], status: Optional[int]):
+    if table == "routes":
+        query = select(routes)
+        date_column = routes.c.datetime
+    elif table == "passengers":
+        query = select(passengers, routes.c.datetime, routes.c.status).select_from(passengers.join(routes))
+        date_column = routes.c.datetime
+    else:
+        query = select(messages)
+        date_column = messages.c.created
+    conditions = []
+    if date_from is not None:
+        conditions.append(date_column >= datetime.datetime.combine(date_from, datetime.time.min))
+    if date_to is not None:
+        conditions.append(date_column < datetime.datetime.combine(date_to + datetime.timedelta(days=1), datetime.time.min))
+    if status is not None and table != "messages":
+        conditions.append(routes.c.status == status)
+    if conditions:
+        query = query.where(and_(*conditions))
+    return PreparedQuery(query), [c.name for c in query.selected_columns]
+
+
+def encode(records: list, columns: list, fmt: str):
+    if fmt == "ndjson":
+        return "".join(
+            json.dumps(jsonable_encoder(dict(record)), ensure_ascii=False) + "\n" for record in records
+        )
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([[record[i] for i in range(len(columns))] for record in records])
+    return buffer.getvalue()
+
+
+async def stream_export(database, query: PreparedQuery, columns: list, fmt: str):
+    # A server side cursor inside a read only REPEATABLE READ transaction:
+    # constant memory, a consistent snapshot and only ACCESS SHARE locks,
+    # which never block inserts or updates from live traffic.
+    pool = database._backend._pool
+    connection = await pool.acquire()
+    try:
+        if fmt == "csv":
+            buffer = io.StringIO()
+            csv.writer(buffer).writerow(columns)
+            yield buffer.getvalue()
+        async with connection.transaction(isolation="repeatable_read", readonly=True):
+            batch = []
+            async for record in connection.cursor(query.sql, *query.args({}), prefetch=BATCH):
+                batch.append(record)
+                if len(batch) == BATCH:
+                    yield encode(batch, columns, fmt)
+                    batch = []
+            if batch:
+                yield encode(batch, columns, fmt)
+    finally:
+        await pool.release(connection)
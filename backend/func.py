@@ -1,5 +1,23 @@
-from datetime import datetime
-from models import messages, database
+import asyncio
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy import DateTime, String, and_, cast, false, func, literal, or_, select
+from sqlalchemy.dialects.postgresql import ARRAY, UUID, insert
+
+from models import messages, offers, database, passengers, reads, route_stops, routes
+from prepared import PreparedQuery
+from queries import expired_messages, retention_end
+from settings import Settings, timezone
+from webs import manager
+
+settings = Settings()
+logger = logging.getLogger(__name__)
+
 
 async def insert_message(route_id: int, user_id: int, text: str, created: datetime, read: bool = False):
 	msg = messages.insert().values(
@@ -8,5 +26,122 @@ async def insert_message(route_id: int, user_id: int, text: str, created: dateti
             route_id=route_id,
             user_id=user_id,
             created=created
-        )
-	await database.execute(msg)
+        ).returning(messages)
+	row = await database.fetch_one(msg)
+	reads.mark_write(user_id)
+	await manager.push_messages([row])
+	return row
+
+
+async def insert_offers(route_id: str, route_ids: List[str], text: str, created: datetime):
+	# one statement for any number of offers: the passenger routes come in as
+	# an array joined with the open passenger requests in routes, the offer
+	# goes to the owner of the request. Ids of other routes are skipped like
+	# offers that already exist are skipped by the unique constraint. A
+	# message is written only for the new offers, returns the ids of the
+	# users that got one
+	data = func.unnest(
+			cast(literal(route_ids, ARRAY(UUID)), ARRAY(UUID))
+		).table_valued("route_p_id").render_derived("data")
+	new_offers = insert(offers).from_select(
+			["route_p_id", "route_d_id", "user_id", "description"],
+			select(
+				data.c.route_p_id,
+				cast(route_id, UUID),
+				routes.c.user_id,
+				cast("Вам запропонували маршрут", String)
+			).select_from(data.join(routes, routes.c.id == data.c.route_p_id)).where(and_(
+				routes.c.car == "",
+				routes.c.status == 0
+			))
+		).on_conflict_do_nothing(
+			index_elements=[offers.c.route_d_id, offers.c.route_p_id]
+		).returning(offers.c.route_d_id, offers.c.user_id).cte("new_offers")
+	msgs = messages.insert().from_select(
+			["text", "read", "route_id", "user_id", "created"],
+			select(
+				cast(text, String),
+				false(),
+				new_offers.c.route_d_id,
+				new_offers.c.user_id,
+				cast(created, DateTime)
+			).select_from(new_offers)
+		).add_cte(new_offers).returning(messages)
+	# databases would map the columns of the RETURNING in the CTE onto the
+	# rows, asyncpg's records know their own names
+	rows = await PreparedQuery(msgs).fetch_all(database)
+	user_ids = [row["user_id"] for row in rows]
+	for user_id in user_ids:
+		reads.mark_write(user_id)
+	await manager.push_messages(rows)
+	return user_ids
+
+
+def new_route_id() -> str:
+	# UUIDv7: the millisecond timestamp leads, so new routes are appended to
+	# the end of the primary key and foreign key indexes instead of random pages
+	rand = int.from_bytes(os.urandom(10), "big")
+	value = (time.time_ns() // 1000000) << 80 | 0x7 << 76 | (rand >> 68) << 64 | 0b10 << 62 | rand & ((1 << 62) - 1)
+	return str(uuid.UUID(int=value))
+
+
+async def insert_stops(route_id: str, cities: List[str]):
+	if not cities:
+		return
+	await database.execute(route_stops.insert().values([
+			{"route_id": route_id, "position": position, "city": city, "booked": 0}
+			for position, city in enumerate(cities)
+		]))
+
+
+async def book_stops(route_id: str, seats: int, from_stop: Optional[int] = None, to_stop: Optional[int] = None):
+	# the segments from_stop -> to_stop, the whole route when not given
+	conditions = [route_stops.c.route_id == route_id, route_stops.c.position >= (from_stop or 0)]
+	if to_stop is not None:
+		conditions.append(route_stops.c.position < to_stop)
+	await database.execute(
+		route_stops.update().where(and_(*conditions)).values(booked=route_stops.c.booked + seats)
+	)
+
+
+async def update_passenger_stops(passenger_id: int, seats: Optional[int] = None):
+	# moves an active booking to a new number of seats, or releases it when
+	# seats is None, in one UPDATE ... FROM passengers
+	if seats is None:
+		delta = -passengers.c.seats
+	else:
+		delta = seats - passengers.c.seats
+	await database.execute(
+		route_stops.update().where(and_(
+			passengers.c.id == passenger_id,
+			passengers.c.description == "",
+			route_stops.c.route_id == passengers.c.route_id,
+			route_stops.c.position >= func.coalesce(passengers.c.from_stop, 0),
+			or_(passengers.c.to_stop == None, route_stops.c.position < passengers.c.to_stop)
+		)).values(booked=route_stops.c.booked + delta)
+	)
+
+
+async def compact_messages(batch: int = 5000):
+	# read messages past the retention window are deleted in small batches so
+	# no long lock is held on messages
+	cutoff = timezone() - timedelta(days=settings.message_retention_days)
+	end = await retention_end.fetch_val(database, cutoff=cutoff)
+	after = 0
+	while True:
+		deleted = await expired_messages.fetch_all(
+			database, after=after, end=end or 2 ** 31 - 1, cutoff=cutoff, batch=batch
+		)
+		if len(deleted) < batch:
+			return
+		after = max(row["id"] for row in deleted)
+
+
+async def retention_loop():
+	while True:
+		try:
+			await compact_messages()
+		except Exception:
+			# the next pass picks up where this one failed
+			logger.exception("message retention pass failed")
+		await asyncio.sleep(settings.message_retention_interval)
@@ -0,0 +1,145 @@
+import csv
+import os
+import re
+from typing import Dict, List, Set
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), "data", "settlements.csv")
+
+# official Ukrainian transliteration (KMU 2010), word initial forms in FIRST
+TRANSLIT = {
+    "а": "a", "б": "b", "в": "v", "г": "h", "ґ": "g", "д": "d", "е": "e", "є": "ie",
+    "ж": "zh", "з": "z", "и": "y", "і": "i", "ї": "i", "й": "i", "к": "k", "л": "l",
+    "м": "m", "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t", "у": "u",
+    "ф": "f", "х": "kh", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "shch", "ь": "", "ю": "iu",
+    "я": "ia", "'": "",
+}
+FIRST = {"є": "ye", "ї": "yi", "й": "y", "ю": "yu", "я": "ya"}
+
+# spellings people mix up: Russian letters, и/і/ї, е/є, apostrophes, soft sign
+FOLD = str.maketrans({
+    "ы": "і", "и": "і", "ї": "і", "э": "е", "є": "е", "ё": "е", "ґ": "г",
+    "ъ": None, "ь": None, "'": None,
+})
+APOSTROPHES = re.compile(r"[’ʼ`´‘]")
+TOKENS = re.compile(r"[^\W\d_]+(?:'[^\W\d_]+)*")
+# what separates stops in a route name, a hyphen only with spaces around it
+# so "Івано-Франківськ" stays one name
+SEPARATORS = re.compile(r"\s+-+\s+|\s*[–—,;/→]\s*")
+WORD_START = re.compile(r"(^|[\s'-])(\w)")
+DOUBLES = re.compile(r"(.)\1+")
+# Russian adjective endings of place names in Latin letters: Вишневое is
+# Вишневе, Новая is Нова
+RUSSIAN_ENDINGS = (("oe", "e"), ("aia", "a"))
+
+
+def transliterate(word: str) -> str:
+    return "".join(
+        FIRST.get(char, TRANSLIT.get(char, char)) if i == 0 else TRANSLIT.get(char, char)
+        for i, char in enumerate(word.lower())
+    )
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKENS.findall(APOSTROPHES.sub("'", text.lower()))
+
+
+def fold(token: str) -> str:
+    return token.translate(FOLD)
+
+
+def romanize(token: str) -> str:
+    # one Latin form for the spellings of a word the gazetteer doesn't know:
+    # Вишневе, Вишневое, Vyshneve and Vishnevoye all give "vishneve"
+    word = transliterate(fold(token)).replace("y", "i").replace("g", "h").replace("w", "v")
+    word = DOUBLES.sub(r"\1", word).replace("ie", "e")
+    for ending, replacement in RUSSIAN_ENDINGS:
+        if word.endswith(ending):
+            return word[:-len(ending)] + replacement
+    return word
+
+
+def capitalize(name: str) -> str:
+    return WORD_START.sub(lambda m: m.group(1) + m.group(2).upper() if m.group(1) != "'" else m.group(0), name)
+
+
+class Gazetteer:
+    # A trie over folded words: every spelling of a settlement is a path
+    # whose end holds the canonical Ukrainian name. Text is scanned word by
+    # word taking the longest match, so "Біла Церква" and "Івано-Франківськ"
+    # are found as one city.
+    def __init__(self):
+        self.trie: Dict[str, dict] = {}
+        self.names: Set[str] = set()
+
+    @classmethod
+    def load(cls, path: str = DATA_PATH):
+        gazetteer = cls()
+        with open(path, encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                name = row["name"]
+                variants = [v for v in row["variants"].split("|") if v]
+                for spelling in [name, *variants]:
+                    gazetteer.add(spelling, name)
+                    gazetteer.add(" ".join(transliterate(w) for w in tokenize(spelling)), name)
+        return gazetteer
+
+    def add(self, spelling: str, name: str):
+        self.names.add(name)
+        node = self.trie
+        for token in tokenize(spelling):
+            node = node.setdefault(fold(token), {})
+        node["$"] = name
+
+    def cities(self, text: str) -> List[str]:
+        # canonical names in the order they appear. Words the gazetteer
+        # doesn't know are kept together as one name up to the next known
+        # city or separator, so "Нова Каховка" isn't split into two stops
+        result = []
+        for part in SEPARATORS.split(APOSTROPHES.sub("'", text)):
+            words = list(TOKENS.finditer(part.lower()))
+            tokens = [fold(word.group()) for word in words]
+            i, unknown = 0, None
+            while i < len(tokens):
+                match, end = self.longest(tokens, i)
+                # "Кам'янка-Бузька" is not Кам'янка followed by an unknown word
+                if match is not None and end < len(tokens) and part[words[end - 1].end():words[end].start()] == "-" \
+                        and self.longest(tokens, end)[0] is None:
+                    match = None
+                if match is None:
+                    unknown = i if unknown is None else unknown
+                    i += 1
+                    continue
+                if unknown is not None:
+                    result.append(capitalize(part[words[unknown].start():words[i - 1].end()]))
+                    unknown = None
+                result.append(match)
+                i = end
+            if unknown is not None:
+                result.append(capitalize(part[words[unknown].start():words[-1].end()]))
+        return result
+
+    def longest(self, tokens: List[str], i: int):
+        node, match, end = self.trie, None, i
+        for j in range(i, len(tokens)):
+            node = node.get(tokens[j])
+            if node is None:
+                break
+            if "$" in node:
+                match, end = node["$"], j + 1
+        return match, end
+
+    def key(self, city: str) -> str:
+        # what route stops are stored and matched by: the canonical name of
+        # a known city, the romanized words of any other name
+        if city in self.names:
+            return city
+        return " ".join(romanize(token) for token in tokenize(city))
+
+    def stops(self, text: str) -> List[str]:
+        return [self.key(city) for city in self.cities(text)]
+
+    def normalize(self, text: str) -> str:
+        return " - ".join(self.stops(text))
+
+
+gazetteer = Gazetteer.load()
@@ -0,0 +1,86 @@
+import csv
+import datetime
+import io
+import json
+from typing import List
+
+from pydantic import ValidationError
+
+from func import new_route_id
+from gazetteer import gazetteer
+from models import database
+from pydmodels import CreateRoute
+
+ROUTE_COLUMNS = ["id", "route", "datetime", "description", "car", "seats", "price", "status", "rating_route", "user_id"]
+STOP_COLUMNS = ["route_id", "position", "city", "booked"]
+MAX_ROWS = 10000
+
+
+def parse_rows(content: bytes, fmt: str):
+    text = content.decode("utf-8-sig")
+    if fmt == "csv":
+        return list(csv.DictReader(io.StringIO(text)))
+    rows = []
+    for line in text.splitlines():
+        if line.strip():
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                rows.append(None)
+    return rows
+
+
+def validate_rows(rows: list):
+    routes, errors = [], []
+    for number, row in enumerate(rows, start=1):
+        if not isinstance(row, dict):
+            errors.append({"row": number, "errors": ["Невірний формат рядка"]})
+            continue
+        # csv.DictReader puts cells past the header under None
+        if None in row:
+            errors.append({"row": number, "errors": ["Більше значень, ніж колонок у заголовку"]})
+            continue
+        # empty CSV cells are missing values, an empty description is fine
+        row = {k: v for k, v in row.items() if v not in ("", None) or k == "description"}
+        try:
+            route = CreateRoute(**row)
+        except ValidationError as e:
+            errors.append({"row": number, "errors": [
+                f"{'.'.join(str(loc) for loc in err['loc'])}: {err['msg']}" for err in e.errors()
+            ]})
+            continue
+        # partner trips are always driver routes
+        if not route.vehicle or not route.seats:
+            errors.append({"row": number, "errors": ["vehicle, seats: обов'язкові поля"]})
+            continue
+        routes.append(route)
+    return routes, errors
+
+
+async def copy_routes(user_id: int, routes: List[CreateRoute]):
+    records, stops = [], []
+    for route in routes:
+        route_id = new_route_id()
+        cities = gazetteer.cities(route.name)
+        records.append((
+            route_id,
+            " - ".join(cities),
+            datetime.datetime.combine(route.date, route.time),
+            route.description,
+            route.vehicle,
+            route.seats,
+            route.price,
+            0,
+            0.0,
+            user_id,
+        ))
+        stops.extend((route_id, position, gazetteer.key(city), 0) for position, city in enumerate(cities))
+    async with database.transaction():
+        async with database.connection() as connection:
+            await connection.raw_connection.copy_records_to_table(
+                "routes", records=records, columns=ROUTE_COLUMNS
+            )
+            await connection.raw_connection.copy_records_to_table(
+                "route_stops", records=stops, columns=STOP_COLUMNS
+            )
+    return [dict(zip(ROUTE_COLUMNS, record)) for record in records]
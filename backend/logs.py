@@ -0,0 +1,87 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import uuid
+from collections import Counter
+from contextvars import ContextVar
+
+from settings import Settings
+
+settings = Settings()
+
+request_id: ContextVar[str] = ContextVar("request_id", default="-")
+
+# LogRecord attributes that aren't fields passed through extra=
+RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id", "sample"}
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+class ContextFilter(logging.Filter):
+    # Runs in the logging call, before the record leaves the event loop
+    # thread: stamps the request id and keeps every n-th record of events
+    # logged with extra={"sample": n}, counted per logger and message.
+    def __init__(self):
+        super().__init__()
+        self.seen = Counter()
+
+    def filter(self, record):
+        record.request_id = request_id.get()
+        rate = getattr(record, "sample", 1)
+        if rate > 1:
+            key = (record.name, record.msg)
+            self.seen[key] += 1
+            if self.seen[key] % rate != 1:
+                return False
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # never block the event loop on a full queue, drop and count instead
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        if getattr(record, "sample", 1) > 1:
+            entry["sample"] = record.sample
+        entry.update({k: v for k, v in vars(record).items() if k not in RESERVED})
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging():
+    # Handlers only put records on a queue, a QueueListener thread formats
+    # them as JSON lines and writes to stdout. LOG_LEVELS='{"webs": "WARNING"}'
+    # sets levels per module logger.
+    handler = DroppingQueueHandler(queue.Queue(settings.log_queue_size))
+    handler.addFilter(ContextFilter())
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(handler.queue, output, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(settings.log_level)
+    for name, level in settings.log_levels.items():
+        logging.getLogger(name).setLevel(level)
+    listener.start()
+    return listener
@@ -0,0 +1,145 @@
+import asyncio
+import datetime
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import and_, func, select
+
+from gazetteer import gazetteer
+from models import database, passengers, routes
+from queries import booked_seats
+from settings import timezone
+from webs import manager
+
+PRUNE_INTERVAL = 3600
+
+
+def route_key(name: str, date: datetime.datetime) -> Optional[Tuple[str, str, datetime.date]]:
+    cities = gazetteer.stops(name or "")
+    if len(cities) < 2:
+        return None
+    return cities[0], cities[-1], date.date()
+
+
+class MatchingEngine:
+    # Open passenger requests (car == "") and driver routes indexed by
+    # (from, to, date). Every change touches only the bucket of the changed
+    # route, a match is pushed to both users over the websocket once.
+    def __init__(self):
+        self.requests: Dict[tuple, Dict[str, dict]] = defaultdict(dict)
+        self.drivers: Dict[tuple, Dict[str, dict]] = defaultdict(dict)
+        self.entries: Dict[str, dict] = {}
+        self._task = None
+
+    async def start(self):
+        booked = select(passengers.c.route_id, func.sum(passengers.c.seats).label("seats"))\
+            .where(passengers.c.description == "")\
+            .group_by(passengers.c.route_id)\
+            .subquery()
+        query = select(
+            routes.c.id, routes.c.user_id, routes.c.route, routes.c.datetime, routes.c.seats, routes.c.car,
+            func.coalesce(booked.c.seats, 0).label("booked")
+        ).select_from(routes.outerjoin(booked, booked.c.route_id == routes.c.id))\
+            .where(and_(routes.c.status == 0, routes.c.datetime >= timezone()))
+        for row in await database.fetch_all(query):
+            self.add(dict(row))
+        # routes that already matched before a restart are not announced again
+        for key, bucket in self.requests.items():
+            for request in bucket.values():
+                for driver in self.candidates(request, self.drivers.get(key, {})):
+                    driver["matched"].add(request["id"])
+                    request["matched"].add(driver["id"])
+        self._task = asyncio.create_task(self.prune_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def bucket(self, entry: dict):
+        return self.drivers if entry["car"] else self.requests
+
+    def add(self, entry: dict):
+        key = route_key(entry["route"], entry["datetime"])
+        if key is None:
+            return None
+        entry["key"] = key
+        entry.setdefault("matched", set())
+        entry.setdefault("booked", 0)
+        self.entries[entry["id"]] = entry
+        self.bucket(entry)[key][entry["id"]] = entry
+        return entry
+
+    def remove(self, route_id: str):
+        entry = self.entries.pop(route_id, None)
+        if entry is None:
+            return
+        bucket = self.bucket(entry)
+        bucket[entry["key"]].pop(route_id, None)
+        if not bucket[entry["key"]]:
+            del bucket[entry["key"]]
+        for other_id in entry["matched"]:
+            if other_id in self.entries:
+                self.entries[other_id]["matched"].discard(route_id)
+        return entry
+
+    def candidates(self, entry: dict, others: Dict[str, dict]):
+        for other in others.values():
+            if other["user_id"] == entry["user_id"]:
+                continue
+            driver, request = (entry, other) if entry["car"] else (other, entry)
+            # seats of a driver route is its capacity, booked ones aren't free
+            if (driver["seats"] or 0) - (driver["booked"] or 0) >= (request["seats"] or 1):
+                yield other
+
+    async def route_changed(self, entry: dict):
+        old = self.remove(entry["id"])
+        if old is not None and old["key"] == route_key(entry["route"], entry["datetime"]):
+            # keep the pairs that were already announced
+            entry["matched"] = old["matched"]
+            for other_id in old["matched"]:
+                if other_id in self.entries:
+                    self.entries[other_id]["matched"].add(entry["id"])
+        entry = self.add(entry)
+        if entry is None:
+            return
+        others = (self.requests if entry["car"] else self.drivers).get(entry["key"], {})
+        for other in list(self.candidates(entry, others)):
+            if other["id"] in entry["matched"]:
+                continue
+            driver, request = (entry, other) if entry["car"] else (other, entry)
+            entry["matched"].add(other["id"])
+            other["matched"].add(entry["id"])
+            await asyncio.gather(
+                manager.send_event(request["user_id"], {"type": "match", "route": self.public(driver)}),
+                manager.send_event(driver["user_id"], {"type": "match", "route": self.public(request)}),
+                return_exceptions=True,
+            )
+
+    async def seats_changed(self, route_id: str, seats: int):
+        entry = self.entries.get(route_id)
+        if entry is not None:
+            await self.route_changed(dict(entry, seats=seats, matched=set()))
+
+    async def booked_changed(self, route_id: str):
+        entry = self.entries.get(route_id)
+        if entry is not None and entry["car"]:
+            booked = await booked_seats.fetch_val(database, route_id=route_id)
+            await self.route_changed(dict(entry, booked=booked or 0))
+
+    def public(self, entry: dict):
+        return jsonable_encoder({k: v for k, v in entry.items() if k not in ("key", "matched")})
+
+    def prune(self):
+        today = timezone().date()
+        for route_id in [i for i, e in self.entries.items() if e["key"][2] < today]:
+            self.remove(route_id)
+
+    async def prune_loop(self):
+        while True:
+            await asyncio.sleep(PRUNE_INTERVAL)
+            self.prune()
+
+
+matcher = MatchingEngine()
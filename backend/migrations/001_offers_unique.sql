@@ -0,0 +1,10 @@
+-- one offer per driver route and passenger route, /offer relies on it for
+-- INSERT ... ON CONFLICT DO NOTHING
+DELETE FROM offers a
+    USING offers b
+    WHERE a.route_d_id = b.route_d_id
+        AND a.route_p_id = b.route_p_id
+        AND a.id > b.id;
+
+ALTER TABLE offers
+    ADD CONSTRAINT offers_route_d_id_route_p_id_key UNIQUE (route_d_id, route_p_id);
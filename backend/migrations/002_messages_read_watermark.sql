@@ -0,0 +1,15 @@
+-- read state moves from messages.read to a per-user watermark
+ALTER TABLE users
+    ADD COLUMN last_read_message_id INTEGER DEFAULT 0,
+    ADD COLUMN last_read_at TIMESTAMP WITHOUT TIME ZONE;
+
+UPDATE users SET last_read_message_id = m.last_id
+    FROM (
+        SELECT user_id, max(id) AS last_id
+        FROM messages
+        WHERE read
+        GROUP BY user_id
+    ) m
+    WHERE m.user_id = users.id;
+
+CREATE INDEX CONCURRENTLY ix_messages_user_id_id ON messages (user_id, id);
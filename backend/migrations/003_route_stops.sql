@@ -0,0 +1,21 @@
+-- route_stops is created here rather than by metadata.create_all: at the
+-- head of the series models declares route_id as uuid, which can't reference
+-- a varchar routes.id. 005_route_uuid.sql converts it with the other tables.
+CREATE TABLE route_stops (
+    id SERIAL PRIMARY KEY,
+    route_id VARCHAR(100) NOT NULL,
+    position INTEGER NOT NULL,
+    city VARCHAR(100) NOT NULL,
+    booked INTEGER NOT NULL DEFAULT 0,
+    CONSTRAINT route_stops_route_id_fkey FOREIGN KEY (route_id) REFERENCES routes (id),
+    CONSTRAINT route_stops_route_id_position_key UNIQUE (route_id, position)
+);
+
+CREATE INDEX ix_route_stops_city_route_id_position ON route_stops (city, route_id, position);
+
+ALTER TABLE passengers
+    ADD COLUMN from_stop INTEGER,
+    ADD COLUMN to_stop INTEGER;
+
+-- stops of existing routes are filled by 003_route_stops_backfill.py once
+-- 005_route_uuid.sql has run, see ORDER.txt for the order
@@ -0,0 +1,56 @@
+"""Stops for routes created before route_stops existed.
+
+Names are split with the gazetteer like create-route and /search do, booked
+seats are counted for the whole route as before. Routes that already have
+stops are skipped, so it is safe to run again. Runs after 005_route_uuid.sql,
+see ORDER.txt.
+
+    python migrations/003_route_stops_backfill.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func, select  # noqa: E402
+from sqlalchemy.dialects.postgresql import insert  # noqa: E402
+
+from gazetteer import gazetteer  # noqa: E402
+from models import engine, passengers, route_stops, routes  # noqa: E402
+
+BATCH = 1000
+
+
+def backfill():
+    booked = select(passengers.c.route_id, func.sum(passengers.c.seats).label("seats"))\
+        .where(passengers.c.description == "")\
+        .group_by(passengers.c.route_id)\
+        .subquery()
+    has_stops = select(route_stops.c.id).where(route_stops.c.route_id == routes.c.id).exists()
+    last_id, total = None, 0
+    while True:
+        query = select(routes.c.id, routes.c.route, func.coalesce(booked.c.seats, 0).label("booked"))\
+            .select_from(routes.outerjoin(booked, booked.c.route_id == routes.c.id))\
+            .where(~has_stops)\
+            .order_by(routes.c.id)\
+            .limit(BATCH)
+        if last_id is not None:
+            query = query.where(routes.c.id > last_id)
+        with engine.begin() as connection:
+            rows = connection.execute(query).fetchall()
+            if not rows:
+                break
+            stops = [
+                {"route_id": row.id, "position": position, "city": city, "booked": row.booked}
+                for row in rows
+                for position, city in enumerate(gazetteer.stops(row.route or ""))
+            ]
+            if stops:
+                connection.execute(insert(route_stops).values(stops).on_conflict_do_nothing())
+        last_id = rows[-1].id
+        total += len(rows)
+        print(f"{total} routes")
+
+
+if __name__ == "__main__":
+    backfill()
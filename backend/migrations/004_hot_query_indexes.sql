@@ -0,0 +1,6 @@
+-- indexes behind the hot queries checked by plan_check.py
+CREATE INDEX CONCURRENTLY ix_routes_user_id_datetime ON routes (user_id, datetime);
+CREATE INDEX CONCURRENTLY ix_routes_status_datetime ON routes (status, datetime);
+CREATE INDEX CONCURRENTLY ix_passengers_route_id ON passengers (route_id);
+CREATE INDEX CONCURRENTLY ix_passengers_user_id ON passengers (user_id);
+CREATE INDEX CONCURRENTLY ix_offers_route_p_id_user_id ON offers (route_p_id, user_id);
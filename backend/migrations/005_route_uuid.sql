@@ -0,0 +1,27 @@
+-- routes.id and every column pointing at it become native uuid, existing
+-- ids are uuid4 strings and cast as they are. offers.route_p_id gets the
+-- foreign key it never had, offers on routes that don't exist are dropped.
+BEGIN;
+
+ALTER TABLE passengers DROP CONSTRAINT passengers_route_id_fkey;
+ALTER TABLE messages DROP CONSTRAINT messages_route_id_fkey;
+ALTER TABLE offers DROP CONSTRAINT offers_route_d_id_fkey;
+ALTER TABLE route_stops DROP CONSTRAINT route_stops_route_id_fkey;
+
+DELETE FROM offers WHERE route_p_id NOT IN (SELECT id FROM routes);
+
+ALTER TABLE routes ALTER COLUMN id TYPE uuid USING id::uuid;
+ALTER TABLE passengers ALTER COLUMN route_id TYPE uuid USING route_id::uuid;
+ALTER TABLE messages ALTER COLUMN route_id TYPE uuid USING route_id::uuid;
+ALTER TABLE offers
+    ALTER COLUMN route_d_id TYPE uuid USING route_d_id::uuid,
+    ALTER COLUMN route_p_id TYPE uuid USING route_p_id::uuid;
+ALTER TABLE route_stops ALTER COLUMN route_id TYPE uuid USING route_id::uuid;
+
+ALTER TABLE passengers ADD CONSTRAINT passengers_route_id_fkey FOREIGN KEY (route_id) REFERENCES routes (id);
+ALTER TABLE messages ADD CONSTRAINT messages_route_id_fkey FOREIGN KEY (route_id) REFERENCES routes (id);
+ALTER TABLE offers ADD CONSTRAINT offers_route_d_id_fkey FOREIGN KEY (route_d_id) REFERENCES routes (id);
+ALTER TABLE offers ADD CONSTRAINT offers_route_p_id_fkey FOREIGN KEY (route_p_id) REFERENCES routes (id);
+ALTER TABLE route_stops ADD CONSTRAINT route_stops_route_id_fkey FOREIGN KEY (route_id) REFERENCES routes (id);
+
+COMMIT;
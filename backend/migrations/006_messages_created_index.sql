@@ -0,0 +1,2 @@
+-- retention deletes old read messages in batches by created
+CREATE INDEX CONCURRENTLY ix_messages_created ON messages (created);
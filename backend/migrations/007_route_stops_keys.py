@@ -0,0 +1,34 @@
+"""Stops of places the gazetteer doesn't know get their gazetteer key.
+
+They held the name as it was typed, so other spellings of it never matched.
+Known cities are left as they are and keys don't change when keyed again,
+so it is safe to run again.
+
+    python migrations/007_route_stops_keys.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import select  # noqa: E402
+
+from gazetteer import gazetteer  # noqa: E402
+from models import engine, route_stops  # noqa: E402
+
+
+def rekey():
+    with engine.connect() as connection:
+        cities = connection.execute(select(route_stops.c.city).distinct()).scalars().all()
+    for city in cities:
+        key = gazetteer.key(city)
+        if key == city:
+            continue
+        # one transaction per name keeps the row locks short
+        with engine.begin() as connection:
+            connection.execute(route_stops.update().where(route_stops.c.city == city).values(city=key))
+        print(f"{city} -> {key}")
+
+
+if __name__ == "__main__":
+    rekey()
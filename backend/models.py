@@ -10,15 +10,26 @@ from sqlalchemy import (
     DateTime,
     MetaData,
     Float,
+    Index,
+    UniqueConstraint,
     create_engine,
 )
 from sqlalchemy.dialects.postgresql import UUID
 import databases
 
+from pool import PoolMonitor, pool_options
+from replica import ReadRouter
 from settings import Settings
 
 settings = Settings()
-database = databases.Database(settings.database_url)
+database = databases.Database(settings.database_url, **pool_options())
+database_monitor = PoolMonitor(database, "primary")
+replica_database = None
+replica_monitor = None
+if settings.database_replica_url:
+    replica_database = databases.Database(settings.database_replica_url, **pool_options())
+    replica_monitor = PoolMonitor(replica_database, "replica")
+reads = ReadRouter(database, replica_database, replica_monitor)
 metadata = MetaData()
 engine = create_engine(settings.database_url)
 
@@ -32,12 +43,15 @@ users = Table(
     Column("password", String(255)),
     Column("rating_user", Float, default=0),
     Column("is_active", Boolean),
+    # messages with id up to the watermark count as read
+    Column("last_read_message_id", Integer, default=0, server_default="0"),
+    Column("last_read_at", DateTime),
 )
 
 routes = Table(
     "routes",
     metadata,
-    Column("id", String(100), primary_key=True),
+    Column("id", UUID, primary_key=True),
     Column("route", String(255)),
     Column("datetime", DateTime),
     Column("price", String(20)),
@@ -46,7 +60,9 @@ routes = Table(
     Column("seats", Integer),
     Column("status", Integer, default=0),
     Column("rating_route", Float, default=0),
-    Column("user_id", ForeignKey("users.id"))
+    Column("user_id", ForeignKey("users.id")),
+    Index("ix_routes_user_id_datetime", "user_id", "datetime"),
+    Index("ix_routes_status_datetime", "status", "datetime"),
 )
 
 passengers = Table(
@@ -59,6 +75,25 @@ passengers = Table(
     Column("description", String(255)),
     Column("rating", Float),
     Column("comment", String(255)),
+    # booked segment as route_stops positions, NULL is the whole route
+    Column("from_stop", Integer),
+    Column("to_stop", Integer),
+    Index("ix_passengers_route_id", "route_id"),
+    Index("ix_passengers_user_id", "user_id"),
+)
+
+# ordered stops of a route, booked counts the seats taken on the segment
+# from this stop to the next one
+route_stops = Table(
+    "route_stops",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("route_id", ForeignKey("routes.id"), nullable=False),
+    Column("position", Integer, nullable=False),
+    Column("city", String(100), nullable=False),
+    Column("booked", Integer, nullable=False, default=0, server_default="0"),
+    UniqueConstraint("route_id", "position"),
+    Index("ix_route_stops_city_route_id_position", "city", "route_id", "position"),
 )
 
 messages = Table(
@@ -69,17 +104,21 @@ messages = Table(
     Column("read", Boolean, default=False),
     Column("created", DateTime),
     Column("route_id", ForeignKey("routes.id")),
-    Column("user_id", ForeignKey("users.id"))
+    Column("user_id", ForeignKey("users.id")),
+    Index("ix_messages_user_id_id", "user_id", "id"),
+    Index("ix_messages_created", "created"),
 )
 
 offers = Table(
     "offers",
     metadata,
     Column("id", Integer, primary_key=True),
-    Column("route_p_id", String(100)),
+    Column("route_p_id", ForeignKey("routes.id")),
     Column("route_d_id", ForeignKey("routes.id")),
     Column("user_id", ForeignKey("users.id")),
-    Column("description", String)
+    Column("description", String),
+    UniqueConstraint("route_d_id", "route_p_id"),
+    Index("ix_offers_route_p_id_user_id", "route_p_id", "user_id"),
 )
 
 metadata.create_all(engine)
@@ -0,0 +1,191 @@
+"""Query plan regression check for the hot queries in queries.py.
+
+Seeds a scratch Postgres at scale, runs EXPLAIN (ANALYZE, BUFFERS) on every
+hot query and fails when a large table is read with a sequential scan or
+when planned cost or buffers grow past the stored baseline.
+
+    PLAN_CHECK_DATABASE_URL=postgresql://localhost/fromto_plans \\
+        python plan_check.py --seed --update-baseline   # once, commit plan_baseline.json
+    PLAN_CHECK_DATABASE_URL=... python plan_check.py --seed
+
+The database is truncated by --seed, never point it at real data.
+"""
+import argparse
+import asyncio
+import csv
+import datetime
+import json
+import os
+import sys
+
+DATABASE_URL = os.environ.get("PLAN_CHECK_DATABASE_URL")
+if not DATABASE_URL:
+    sys.exit("PLAN_CHECK_DATABASE_URL is not set")
+# models creates its tables on import, make it do so in the scratch database
+os.environ["DATABASE_URL"] = DATABASE_URL
+os.environ.pop("DATABASE_REPLICA_URL", None)
+
+import asyncpg  # noqa: E402
+
+from gazetteer import DATA_PATH  # noqa: E402
+from queries import (active_booking, booked_seats, dashboard,  # noqa: E402
+                     expired_messages, messages_after, my_seats,
+                     passengers_by_route, retention_end, route_by_id,
+                     route_offers, search_city_drivers, search_segment_drivers,
+                     unread_count, unread_counts, user_with_active_route)
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "plan_baseline.json")
+LARGE_TABLES = {"users", "routes", "passengers", "messages", "offers", "route_stops"}
+TOLERANCE = 1.5
+BUFFER_SLACK = 16
+
+USERS = 20000
+ROUTES = 200000
+PASSENGERS = 200000
+MESSAGES = 1000000
+OFFERS = 100000
+
+
+def seed_statements():
+    with open(DATA_PATH, encoding="utf-8") as f:
+        names = [row["name"].replace("'", "''") for row in csv.DictReader(f)]
+    cities = "ARRAY[" + ",".join(f"'{name}'" for name in names) + "]"
+    n = len(names)
+    route_id = "md5(({})::text)::uuid"
+    return [
+        "TRUNCATE route_stops, offers, messages, passengers, routes, users RESTART IDENTITY CASCADE",
+        f"""INSERT INTO users (id, name, phone, email, password, rating_user, is_active, last_read_message_id)
+            SELECT i, 'user' || i, '+380' || i, 'user' || i || '@example.com', '', 0, true,
+                CASE WHEN i % 10 = 0 THEN 0 ELSE {MESSAGES} - 50000 END
+            FROM generate_series(1, {USERS}) i""",
+        f"""INSERT INTO routes (id, route, datetime, price, description, car, seats, status, rating_route, user_id)
+            SELECT {route_id.format("i")},
+                c[1 + i % {n}] || ' - ' || c[1 + (i * 7 + 3) % {n}],
+                now() - interval '300 days' + (i % 360) * interval '1 day' + (i % 24) * interval '1 hour',
+                '300', '', CASE WHEN i % 3 = 0 THEN '' ELSE 'car' END, 1 + i % 4,
+                CASE WHEN i % 10 = 0 THEN 1 ELSE 0 END, 0, 1 + i % {USERS}
+            FROM generate_series(1, {ROUTES}) i, (SELECT {cities} AS c) cities""",
+        """INSERT INTO route_stops (route_id, position, city, booked)
+            SELECT r.id, s.position - 1, s.city, 0
+            FROM routes r
+            CROSS JOIN LATERAL regexp_split_to_table(r.route, ' - ') WITH ORDINALITY AS s (city, position)""",
+        f"""INSERT INTO passengers (route_id, user_id, seats, description)
+            SELECT {route_id.format(f"1 + i % {ROUTES}")}, 1 + (i * 13) % {USERS}, 1,
+                CASE WHEN i % 5 = 0 THEN 'Ви відмінили бронь' ELSE '' END
+            FROM generate_series(1, {PASSENGERS}) i""",
+        f"""INSERT INTO messages (text, read, created, route_id, user_id)
+            SELECT 'message', false, now() - interval '400 days' + i * interval '400 days' / {MESSAGES},
+                {route_id.format(f"1 + i % {ROUTES}")}, 1 + i % {USERS}
+            FROM generate_series(1, {MESSAGES}) i""",
+        f"""INSERT INTO offers (route_p_id, route_d_id, user_id, description)
+            SELECT {route_id.format(f"1 + i % {ROUTES}")}, {route_id.format(f"1 + (i * 17) % {ROUTES}")},
+                1 + i % {USERS}, ''
+            FROM generate_series(1, {OFFERS}) i
+            ON CONFLICT DO NOTHING""",
+        # sets the visibility map too, index-only scans depend on it
+        "VACUUM ANALYZE",
+    ]
+
+
+async def checks(connection):
+    now = await connection.fetchval("SELECT now()::timestamp")
+    route = await connection.fetchrow(
+        "SELECT id, user_id FROM routes WHERE status = 0 AND datetime >= now() ORDER BY datetime LIMIT 1"
+    )
+    request = await connection.fetchrow("SELECT route_p_id, user_id FROM offers ORDER BY id LIMIT 1")
+    cutoff = now - datetime.timedelta(days=90)
+    end = await connection.fetchval(retention_end.sql, *retention_end.args({"cutoff": cutoff}))
+    passenger = await connection.fetchval(
+        "SELECT p.user_id FROM passengers p JOIN routes r ON r.id = p.route_id WHERE r.datetime >= now() LIMIT 1"
+    )
+    return [
+        ("user with active route", user_with_active_route, {"id": route["user_id"], "now": now}),
+        ("unread count", unread_count, {"user_id": route["user_id"]}),
+        ("unread counts", unread_counts, {"user_ids": list(range(1, 1001))}),
+        ("messages after", messages_after, {"user_id": route["user_id"], "last_id": MESSAGES - 1000}),
+        ("retention end", retention_end, {"cutoff": cutoff}),
+        ("expired messages", expired_messages, {"after": 0, "end": end, "cutoff": cutoff, "batch": 5000}),
+        ("route by id", route_by_id, {"id": route["id"]}),
+        ("booked seats", booked_seats, {"route_id": route["id"]}),
+        ("passengers by route", passengers_by_route, {"route_id": route["id"]}),
+        ("route offers", route_offers, {"route_id": request["route_p_id"], "user_id": request["user_id"]}),
+        ("dashboard", dashboard, {"user_id": route["user_id"], "route_id": route["id"]}),
+        ("my seats", my_seats, {"user_id": passenger, "now": now}),
+        ("active booking", active_booking, {"user_id": passenger, "now": now}),
+        ("segment search", search_segment_drivers,
+            {"from_city": "Київ", "to_city": "Львів", "seats": 1, "date": now, "limit": 50}),
+        ("city search", search_city_drivers, {"city": "Київ", "seats": 1, "date": now, "limit": 50}),
+    ]
+
+
+def walk(node):
+    yield node
+    for child in node.get("Plans", []):
+        yield from walk(child)
+
+
+def summarize(plan):
+    root = plan["Plan"]
+    return {
+        "cost": root["Total Cost"],
+        "buffers": root.get("Shared Hit Blocks", 0) + root.get("Shared Read Blocks", 0),
+        "seq_scans": sorted({
+            node["Relation Name"] for node in walk(root)
+            if node["Node Type"] == "Seq Scan" and node.get("Relation Name") in LARGE_TABLES
+        }),
+    }
+
+
+async def main(seed: bool, update_baseline: bool):
+    connection = await asyncpg.connect(DATABASE_URL)
+    try:
+        if seed:
+            for statement in seed_statements():
+                await connection.execute(statement)
+        results = {}
+        for name, query, values in await checks(connection):
+            # ANALYZE runs the statement, the retention DELETE is rolled back
+            transaction = connection.transaction()
+            await transaction.start()
+            try:
+                explain = await connection.fetchval(
+                    "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query.sql, *query.args(values)
+                )
+            finally:
+                await transaction.rollback()
+            results[name] = summarize(json.loads(explain)[0])
+    finally:
+        await connection.close()
+
+    if update_baseline:
+        with open(BASELINE_PATH, "w") as f:
+            json.dump({name: {k: r[k] for k in ("cost", "buffers")} for name, r in results.items()}, f, indent=4)
+        print(f"baseline written to {BASELINE_PATH}")
+    if not os.path.exists(BASELINE_PATH):
+        sys.exit("no baseline, run with --update-baseline first")
+    with open(BASELINE_PATH) as f:
+        baseline = json.load(f)
+
+    failed = False
+    for name, result in results.items():
+        problems = [f"seq scan on {table}" for table in result["seq_scans"]]
+        base = baseline.get(name)
+        if base is None:
+            problems.append("not in baseline")
+        else:
+            if result["cost"] > base["cost"] * TOLERANCE:
+                problems.append(f"cost {result['cost']:.0f} > baseline {base['cost']:.0f}")
+            if result["buffers"] > base["buffers"] * TOLERANCE + BUFFER_SLACK:
+                problems.append(f"buffers {result['buffers']} > baseline {base['buffers']}")
+        failed = failed or bool(problems)
+        status = "FAIL " + "; ".join(problems) if problems else "ok"
+        print(f"{name:<24} cost {result['cost']:>10.1f}  buffers {result['buffers']:>7}  {status}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", action="store_true", help="truncate and fill the database first")
+    parser.add_argument("--update-baseline", action="store_true", help="store the current plans as the baseline")
+    args = parser.parse_args()
+    asyncio.run(main(args.seed, args.update_baseline))
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import time
+import uuid
+
+import asyncpg
+
+from settings import Settings
+
+settings = Settings()
+logger = logging.getLogger(__name__)
+
+
+async def init_connection(connection):
+    # uuid keys keep the string form the API has always used, asyncpg would
+    # hand out its own UUID objects otherwise
+    await connection.set_type_codec(
+        "uuid",
+        schema="pg_catalog",
+        encoder=lambda value: (value if isinstance(value, uuid.UUID) else uuid.UUID(value)).bytes,
+        decoder=lambda data: str(uuid.UUID(bytes=bytes(data))),
+        format="binary",
+    )
+
+
+def pool_options():
+    # databases passes these straight to asyncpg.create_pool
+    return dict(
+        init=init_connection,
+        min_size=settings.db_pool_min_size,
+        max_size=settings.db_pool_max_size,
+        max_queries=settings.db_pool_max_queries,
+        max_inactive_connection_lifetime=settings.db_pool_max_inactive_lifetime,
+        statement_cache_size=settings.db_statement_cache_size,
+        command_timeout=settings.db_command_timeout,
+    )
+
+
+class PoolTimeoutError(Exception):
+    # no connection came free in time, api.py answers it with 503
+    pass
+
+
+class TimedPool:
+    # asyncpg's Pool has __slots__, so acquire can't be replaced on it,
+    # databases gets this proxy in its place instead
+    def __init__(self, pool, acquire):
+        self._pool = pool
+        self.acquire = acquire
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+
+class PoolMonitor:
+    def __init__(self, database, name: str):
+        self.database = database
+        self.name = name
+        self.acquired = 0
+        self.timeouts = 0
+        self.recycled = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._acquire = None
+        self._task = None
+
+    @property
+    def pool(self):
+        return self.database._backend._pool
+
+    async def start(self):
+        self.instrument()
+        await self.warm_up()
+        self._task = asyncio.create_task(self.health_check())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def instrument(self):
+        # databases awaits pool.acquire() without a timeout, wrap it to bound
+        # the wait and record how long requests queue for a connection
+        pool = self.pool
+        self._acquire = pool.acquire
+
+        async def timed_acquire(timeout=settings.db_pool_acquire_timeout):
+            start = time.perf_counter()
+            try:
+                connection = await self._acquire(timeout=timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                logger.warning("pool acquire timed out", extra={"pool": self.name, "timeout": timeout})
+                raise PoolTimeoutError(self.name)
+            wait = time.perf_counter() - start
+            self.acquired += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            return connection
+
+        self.database._backend._pool = TimedPool(pool, timed_acquire)
+
+    async def warm_up(self):
+        async def ping():
+            async with self._acquire(timeout=settings.db_pool_acquire_timeout) as con:
+                await con.fetchval("SELECT 1")
+
+        await asyncio.gather(*[ping() for _ in range(self.pool.get_min_size())])
+
+    async def health_check(self):
+        while True:
+            await asyncio.sleep(settings.db_health_check_interval)
+            try:
+                async with self._acquire(timeout=settings.db_pool_acquire_timeout) as con:
+                    await con.fetchval("SELECT 1")
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError):
+                # broken connections are replaced on their next acquire
+                self.recycled += 1
+                logger.warning("pool health check failed, expiring connections", extra={"pool": self.name})
+                await self.pool.expire_connections()
+
+    def stats(self):
+        pool = self.pool
+        if pool is None:
+            return {"name": self.name, "connected": False}
+        size = pool.get_size()
+        in_use = size - pool.get_idle_size()
+        return {
+            "name": self.name,
+            "connected": True,
+            "size": size,
+            "idle": pool.get_idle_size(),
+            "in_use": in_use,
+            "min_size": pool.get_min_size(),
+            "max_size": pool.get_max_size(),
+            "saturation": in_use / pool.get_max_size(),
+            "acquired": self.acquired,
+            "timeouts": self.timeouts,
+            "recycled": self.recycled,
+            "wait_avg_ms": self.wait_total / self.acquired * 1000 if self.acquired else 0,
+            "wait_max_ms": self.wait_max * 1000,
+        }
@@ -0,0 +1,33 @@
+from sqlalchemy.dialects.postgresql import pypostgresql
+
+# the same dialect databases compiles with for asyncpg
+dialect = pypostgresql.dialect(paramstyle="pyformat")
+
+
+class PreparedQuery:
+    # Compiles a SQLAlchemy Core construct once into asyncpg's $n form.
+    # Values are bound per call by name, anything not passed keeps the value
+    # the construct was built with. asyncpg caches the prepared statement per
+    # connection by SQL text, so repeated calls skip both compilation and
+    # PREPARE.
+    def __init__(self, query):
+        compiled = query.compile(dialect=dialect, compile_kwargs={"render_postcompile": True})
+        mapping = {key: "$" + str(i) for i, key in enumerate(compiled.params, start=1)}
+        self.sql = compiled.string % mapping
+        self.names = list(compiled.params)
+        self.defaults = compiled.params
+
+    def args(self, values: dict):
+        return [values[name] if name in values else self.defaults[name] for name in self.names]
+
+    async def fetch_one(self, database, **values):
+        async with database.connection() as connection:
+            return await connection.raw_connection.fetchrow(self.sql, *self.args(values))
+
+    async def fetch_all(self, database, **values):
+        async with database.connection() as connection:
+            return await connection.raw_connection.fetch(self.sql, *self.args(values))
+
+    async def fetch_val(self, database, **values):
+        async with database.connection() as connection:
+            return await connection.raw_connection.fetchval(self.sql, *self.args(values))
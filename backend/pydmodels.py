@@ -1,7 +1,10 @@
 import datetime
-from typing import Optional
+from typing import List, Optional
 
-from pydantic import BaseModel, validator
+from pydantic import BaseModel, constr, validator
+
+# routes are keyed by uuid, a malformed id is rejected here instead of by postgres
+RouteId = constr(regex=r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$")
 
 
 class Phone(BaseModel):
@@ -65,6 +68,13 @@ class Search(BaseModel):
     datetime: datetime.date
     seats: int
     driver: bool
+    limit: int = 50
+
+    @validator("limit")
+    def check_limit(cls, v):
+        if not 0 < v <= 100:
+            raise ValueError("limit")
+        return v
 
     @validator("datetime")
     def check_date(cls, v):
@@ -84,14 +94,16 @@ class User(BaseModel):
 class SetPassengers(BaseModel):
     seats: int
     description: str
-    router: str
+    router: RouteId
     name: str
     owner_id: Optional[int] = None
     datetime: str
+    from_city: Optional[str] = None
+    to_city: Optional[str] = None
 
 
 class Route(BaseModel):
-    id: str
+    id: RouteId
     name: Optional[str] = None
     datetime: Optional[str] = None
 
@@ -107,20 +119,40 @@ class UpdateRoute(Route):
         return v
 
 
+class UpdatePassenger(BaseModel):
+    # /update-route changes the seats of a passenger row, id is passengers.id
+    id: int
+    seats: int
+
+
 class DeleteRoute(BaseModel):
     pass_id: int
     user_id: int
     datetime: str
     route_name: str
-    route_id: str
+    route_id: RouteId
 
 
 class RemovePassenger(BaseModel):
     user_id: int
     pass_id: int
-    route_id: str
+    route_id: RouteId
 
 
 class PassengerData(BaseModel):
-    route_id: str
-    user_id: int
+    route_id: RouteId
+
+
+MAX_BULK_OFFERS = 500
+
+
+class BulkOffer(BaseModel):
+    routes: List[PassengerData]
+
+    @validator("routes")
+    def check_routes(cls, v):
+        if not v:
+            raise ValueError("Немає маршрутів")
+        if len(v) > MAX_BULK_OFFERS:
+            raise ValueError(f"Не більше {MAX_BULK_OFFERS} маршрутів за раз")
+        return v
@@ -0,0 +1,209 @@
+from sqlalchemy import Integer, and_, bindparam, desc, func, literal_column, select
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from models import messages, offers, passengers, route_stops, routes, users
+from prepared import PreparedQuery
+
+user_by_id = PreparedQuery(
+    users.select().where(users.c.id == bindparam("id"))
+)
+
+# the user together with their active route, route columns come back
+# prefixed with "route_" and are all NULL when there is none
+user_with_active_route = PreparedQuery(
+    select(users, *[c.label("route_" + c.name) for c in routes.c])
+        .select_from(users.outerjoin(routes, and_(
+            routes.c.user_id == users.c.id,
+            routes.c.status == 0,
+            routes.c.datetime >= bindparam("now")
+        )))
+        .where(users.c.id == bindparam("id"))
+        .order_by(routes.c.datetime)
+        .limit(1)
+)
+
+def read_watermark(user_id):
+    return func.coalesce(
+        select(users.c.last_read_message_id).where(users.c.id == user_id).scalar_subquery(), 0
+    )
+
+
+_unread_count = select(func.count(messages.c.id)).where(and_(
+    messages.c.user_id == bindparam("user_id"),
+    messages.c.id > read_watermark(bindparam("user_id"))
+))
+
+unread_count = PreparedQuery(_unread_count)
+
+messages_after = PreparedQuery(
+    select(messages).where(and_(
+        messages.c.user_id == bindparam("user_id"),
+        messages.c.id > bindparam("last_id")
+    )).order_by(messages.c.id)
+)
+
+# unread counts of many users at once, the ids come as one array so the
+# statement is the same for any number of users
+unread_counts = PreparedQuery(
+    select(messages.c.user_id, func.count(messages.c.id).label("count"))
+        .select_from(messages.join(users))
+        .where(and_(
+            messages.c.user_id == func.any(bindparam("user_ids", type_=ARRAY(Integer))),
+            users.c.id == func.any(bindparam("user_ids", type_=ARRAY(Integer))),
+            messages.c.id > func.coalesce(users.c.last_read_message_id, 0)
+        ))
+        .group_by(messages.c.user_id)
+)
+
+# retention walks messages by id up to the first one newer than the cutoff,
+# each batch starts after the last id the previous one deleted
+retention_end = PreparedQuery(
+    select(messages.c.id).where(messages.c.created >= bindparam("cutoff")).order_by(messages.c.created).limit(1)
+)
+
+expired_messages = PreparedQuery(
+    messages.delete().where(messages.c.id == func.any(func.array(
+        select(messages.c.id).select_from(messages.join(users)).where(and_(
+            messages.c.id > bindparam("after"),
+            messages.c.id < bindparam("end"),
+            messages.c.created < bindparam("cutoff"),
+            messages.c.id <= users.c.last_read_message_id
+        )).order_by(messages.c.id).limit(bindparam("batch")).scalar_subquery()
+    ))).returning(messages.c.id)
+)
+
+
+def _search(is_driver, *conditions):
+    return PreparedQuery(
+        select(routes, users.c.name, users.c.rating_user)
+            .select_from(routes.join(users))
+            .where(and_(
+                routes.c.seats >= bindparam("seats"),
+                routes.c.status == 0,
+                routes.c.datetime >= bindparam("date"),
+                is_driver,
+                *conditions
+            ))
+            .order_by(routes.c.datetime)
+            .limit(bindparam("limit"))
+    )
+
+
+# a stop in the city, found through the route_stops city index where a
+# LIKE on routes.route had to read every route
+_stops_in_city = select(route_stops.c.id).where(and_(
+    route_stops.c.route_id == routes.c.id,
+    route_stops.c.city == bindparam("city")
+)).exists()
+
+
+def _search_segment(is_driver):
+    # routes with a stop in "from" followed later by a stop in "to", free
+    # seats are the route seats minus the busiest segment in between
+    start = route_stops.alias("start")
+    end = route_stops.alias("end")
+    segment = route_stops.alias("segment")
+    free_seats = func.coalesce(routes.c.seats, 0) - func.max(segment.c.booked)
+    return PreparedQuery(
+        select(routes, users.c.name, users.c.rating_user, free_seats.label("free_seats"))
+            .select_from(
+                start.join(end, and_(end.c.route_id == start.c.route_id, end.c.position > start.c.position))
+                    .join(segment, and_(
+                        segment.c.route_id == start.c.route_id,
+                        segment.c.position >= start.c.position,
+                        segment.c.position < end.c.position
+                    ))
+                    .join(routes, routes.c.id == start.c.route_id)
+                    .join(users, users.c.id == routes.c.user_id)
+            )
+            .where(and_(
+                start.c.city == bindparam("from_city"),
+                end.c.city == bindparam("to_city"),
+                routes.c.status == 0,
+                routes.c.datetime >= bindparam("date"),
+                is_driver
+            ))
+            .group_by(routes.c.id, users.c.name, users.c.rating_user)
+            .having(free_seats >= bindparam("seats"))
+            .order_by(routes.c.datetime)
+            .limit(bindparam("limit"))
+    )
+
+
+# passengers look for drivers and drivers look for passenger requests
+search_drivers = _search(routes.c.car != "")
+search_passengers = _search(routes.c.car == "")
+search_city_drivers = _search(routes.c.car != "", _stops_in_city)
+search_city_passengers = _search(routes.c.car == "", _stops_in_city)
+search_segment_drivers = _search_segment(routes.c.car != "")
+search_segment_passengers = _search_segment(routes.c.car == "")
+
+route_by_id = PreparedQuery(
+    select(routes, users.c.name, users.c.rating_user)
+        .select_from(routes.join(users))
+        .where(routes.c.id == bindparam("id"))
+)
+
+_route_passengers = select(
+    routes.c.datetime, passengers.c.id, passengers.c.route_id, passengers.c.seats, passengers.c.description,
+    users.c.id.label("user_id"), users.c.name, users.c.email, users.c.phone
+)\
+    .select_from(routes.join(passengers).join(users))\
+    .where(and_(passengers.c.route_id == bindparam("route_id"), passengers.c.description == ""))
+
+passengers_by_route = PreparedQuery(_route_passengers)
+
+# the user's booking on an upcoming route
+my_seats = PreparedQuery(
+    select(routes, passengers.c.id.label("p_id"), passengers.c.seats.label("booking_seats"),
+           users.c.id, users.c.name, users.c.phone)
+        .select_from(routes.join(passengers).join(users))
+        .where(and_(
+            passengers.c.user_id == bindparam("user_id"),
+            routes.c.datetime >= bindparam("now"),
+            routes.c.status == 0,
+            passengers.c.description.like("")
+        ))
+        .order_by(desc(routes.c.datetime))
+)
+
+active_booking = PreparedQuery(
+    select(passengers.c.id).select_from(passengers.join(routes)).where(and_(
+        passengers.c.user_id == bindparam("user_id"),
+        routes.c.datetime > bindparam("now"),
+        passengers.c.description == ""
+    ))
+)
+
+_booked_seats = select(func.sum(passengers.c.seats)).where(and_(
+    passengers.c.route_id == bindparam("route_id"),
+    passengers.c.description.like("")
+))
+
+booked_seats = PreparedQuery(_booked_seats)
+
+_route_offers = select(
+    offers.c.id.label("offer"), routes.c.route, routes.c.id, routes.c.seats, routes.c.datetime, routes.c.status
+)\
+    .select_from(offers.join(routes, routes.c.id == offers.c.route_d_id))\
+    .where(and_(offers.c.route_p_id == bindparam("route_id"), offers.c.user_id == bindparam("user_id")))
+
+route_offers = PreparedQuery(_route_offers)
+
+
+def json_rows(query, name):
+    rows = query.subquery(name)
+    return select(func.coalesce(func.json_agg(literal_column(name)), literal_column("'[]'::json")))\
+        .select_from(rows).scalar_subquery()
+
+
+# everything the app start screen shows for the user's active route in one
+# statement, passengers and offers come back as json arrays
+dashboard = PreparedQuery(
+    select(
+        _booked_seats.scalar_subquery().label("sum"),
+        _unread_count.scalar_subquery().label("number_messages"),
+        json_rows(_route_passengers, "p").label("passengers"),
+        json_rows(_route_offers, "o").label("offers"),
+    )
+)
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+import asyncpg
+
+from pool import PoolTimeoutError
+from prepared import PreparedQuery
+from settings import Settings
+
+settings = Settings()
+logger = logging.getLogger(__name__)
+
+REPLICA_ERRORS = (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError,
+                  PoolTimeoutError)
+
+
+class ReadRouter:
+    # replica is None when no DATABASE_REPLICA_URL is set, every read then
+    # goes to the primary
+    def __init__(self, primary, replica, replica_monitor=None):
+        self.primary = primary
+        self.replica = replica
+        self.replica_monitor = replica_monitor
+        self.connected = False
+        self.healthy = False
+        self.lag = None
+        self.recent_writers: Dict[int, float] = {}
+        self._task = None
+
+    async def start(self):
+        # a replica that is down doesn't keep the API from starting, reads
+        # stay on the primary and the monitor keeps trying to connect
+        if self.replica is None:
+            return
+        if await self.connect():
+            await self.check_replica()
+        self._task = asyncio.create_task(self.monitor())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.connected:
+            await self.replica_monitor.stop()
+            await self.replica.disconnect()
+            self.connected = False
+
+    async def connect(self) -> bool:
+        try:
+            await self.replica.connect()
+            await self.replica_monitor.start()
+        except REPLICA_ERRORS as exc:
+            logger.warning("replica connection failed, reading from the primary", extra={"error": repr(exc)})
+            await self.replica_monitor.stop()
+            if self.replica.is_connected:
+                await self.replica.disconnect()
+            return False
+        self.connected = True
+        return True
+
+    async def check_replica(self):
+        # The replay timestamp only moves when the primary commits, so on a
+        # quiet primary now() - timestamp grows although nothing is missing.
+        # A replica that replayed the WAL up to the primary's current
+        # position has no lag. Its own receive position is no use here, it
+        # stops together with a broken WAL receiver.
+        query = """
+            SELECT pg_is_in_recovery() AS recovery,
+                pg_last_wal_replay_lsn() >= CAST(:primary_lsn AS pg_lsn) AS caught_up,
+                EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) AS lag
+        """
+        try:
+            primary_lsn = await self.primary.fetch_val("SELECT pg_current_wal_lsn()")
+            row = await self.replica.fetch_one(query, {"primary_lsn": primary_lsn})
+        except REPLICA_ERRORS:
+            self.healthy = False
+            self.lag = None
+            return
+        if not row["recovery"] or row["caught_up"]:
+            self.lag = 0.0
+        elif row["lag"] is None:
+            # behind the primary without a transaction replayed since start
+            self.healthy = False
+            self.lag = None
+            return
+        else:
+            self.lag = float(row["lag"])
+        self.healthy = self.lag <= settings.replica_max_lag
+
+    async def monitor(self):
+        while True:
+            await asyncio.sleep(settings.replica_check_interval)
+            if self.connected or await self.connect():
+                await self.check_replica()
+            self.forget_writers()
+
+    def mark_write(self, user_id: Optional[int]):
+        if user_id is not None:
+            self.recent_writers[int(user_id)] = time.monotonic()
+
+    def forget_writers(self):
+        deadline = time.monotonic() - settings.read_your_writes_window
+        for user_id, written in list(self.recent_writers.items()):
+            if written < deadline:
+                del self.recent_writers[user_id]
+
+    def reader(self, user_id: Optional[int] = None):
+        if self.replica is None or not self.healthy:
+            return self.primary
+        if user_id is not None:
+            written = self.recent_writers.get(int(user_id))
+            if written is not None and time.monotonic() - written < settings.read_your_writes_window:
+                return self.primary
+        return self.replica
+
+    async def _call(self, database, method: str, query, values: Optional[dict]):
+        if isinstance(query, PreparedQuery):
+            return await getattr(query, method)(database, **(values or {}))
+        return await getattr(database, method)(query, values)
+
+    async def _read(self, method: str, query, values: Optional[dict], user_id: Optional[int]):
+        database = self.reader(user_id)
+        if database is self.primary:
+            return await self._call(database, method, query, values)
+        try:
+            return await self._call(database, method, query, values)
+        except REPLICA_ERRORS:
+            self.healthy = False
+            return await self._call(self.primary, method, query, values)
+
+    async def fetch_one(self, query, values: Optional[dict] = None, user_id: Optional[int] = None):
+        return await self._read("fetch_one", query, values, user_id)
+
+    async def fetch_all(self, query, values: Optional[dict] = None, user_id: Optional[int] = None):
+        return await self._read("fetch_all", query, values, user_id)
+
+    async def fetch_val(self, query, values: Optional[dict] = None, user_id: Optional[int] = None):
+        return await self._read("fetch_val", query, values, user_id)
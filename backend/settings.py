@@ -1,4 +1,5 @@
 import os
+from typing import Dict, List, Optional
 from datetime import datetime, timedelta
 
 from pydantic import BaseSettings
@@ -21,6 +22,7 @@ class Settings(BaseSettings):
 
     app_url: str
     database_url: str
+    database_replica_url: Optional[str] = None
     mail_username: str
     mail_password: str
     mail_from: str
@@ -28,5 +30,26 @@ class Settings(BaseSettings):
     algorithm: str
     access_token_expire_minutes: int
 
+    db_pool_min_size: int = 5
+    db_pool_max_size: int = 20
+    db_pool_acquire_timeout: float = 10
+    db_pool_max_queries: int = 50000
+    db_pool_max_inactive_lifetime: float = 300
+    db_statement_cache_size: int = 100
+    db_command_timeout: float = 30
+    db_health_check_interval: float = 30
+    replica_max_lag: float = 5
+    replica_check_interval: float = 5
+    read_your_writes_window: float = 10
+    message_retention_days: int = 90
+    message_retention_interval: float = 86400
+    # JSON lists, e.g. PARTNER_USER_IDS='[12, 40]'
+    partner_user_ids: List[int] = []
+    admin_user_ids: List[int] = []
+    log_level: str = "INFO"
+    # JSON object of logger name to level, e.g. LOG_LEVELS='{"webs": "WARNING"}'
+    log_levels: Dict[str, str] = {}
+    log_queue_size: int = 10000
+
     class Config:
         env_file = ".env"
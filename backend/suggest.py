@@ -0,0 +1,87 @@
+import asyncio
+import bisect
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from sqlalchemy import and_, select
+
+from gazetteer import APOSTROPHES, fold, gazetteer, transliterate
+from models import database, routes
+from settings import timezone
+
+PRUNE_INTERVAL = 3600
+
+
+def index_key(text: str) -> str:
+    return fold(APOSTROPHES.sub("'", text.lower()).strip())
+
+
+class CityIndex:
+    # Cities of upcoming active routes. keys is a sorted list of
+    # (folded spelling, city) so a prefix is a bisect plus a short scan,
+    # counts ranks the cities by how many upcoming routes use them.
+    def __init__(self):
+        self.counts: Counter = Counter()
+        self.keys: List[Tuple[str, str]] = []
+        self.route_cities: Dict[str, Tuple[list, object]] = {}
+        self._task = None
+
+    async def start(self):
+        query = select(routes.c.id, routes.c.route, routes.c.datetime).where(and_(
+            routes.c.status == 0,
+            routes.c.datetime >= timezone()
+        ))
+        for row in await database.fetch_all(query):
+            self.add_route(row["id"], row["route"], row["datetime"])
+        self._task = asyncio.create_task(self.prune_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def add_route(self, route_id: str, name: str, date):
+        self.remove_route(route_id)
+        names = list(dict.fromkeys(gazetteer.cities(name or "")))
+        self.route_cities[route_id] = (names, date)
+        for city in names:
+            if self.counts[city] == 0:
+                for key in {index_key(city), index_key(transliterate(city))}:
+                    bisect.insort(self.keys, (key, city))
+            self.counts[city] += 1
+
+    def remove_route(self, route_id: str):
+        names, _ = self.route_cities.pop(route_id, ([], None))
+        for city in names:
+            self.counts[city] -= 1
+            if self.counts[city] <= 0:
+                del self.counts[city]
+                for key in {index_key(city), index_key(transliterate(city))}:
+                    i = bisect.bisect_left(self.keys, (key, city))
+                    if i < len(self.keys) and self.keys[i] == (key, city):
+                        del self.keys[i]
+
+    def suggest(self, q: str, limit: int = 10):
+        prefix = index_key(q)
+        if not prefix:
+            return []
+        found = set()
+        i = bisect.bisect_left(self.keys, (prefix, ""))
+        while i < len(self.keys) and self.keys[i][0].startswith(prefix):
+            found.add(self.keys[i][1])
+            i += 1
+        ranked = sorted(found, key=lambda city: (-self.counts[city], city))[:limit]
+        return [{"name": city, "routes": self.counts[city]} for city in ranked]
+
+    def prune(self):
+        now = timezone()
+        for route_id in [i for i, (_, date) in self.route_cities.items() if date < now]:
+            self.remove_route(route_id)
+
+    async def prune_loop(self):
+        while True:
+            await asyncio.sleep(PRUNE_INTERVAL)
+            self.prune()
+
+
+city_index = CityIndex()
@@ -1,22 +1,24 @@
+import asyncio
+import logging
 import os
-from typing import Dict
+from typing import Dict, Optional
 
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
 from jose import JWTError, jwt
-from sqlalchemy import and_, func, select
+from sqlalchemy import and_, select
 
 from auth import ALGORITHM
-from models import database, messages, passengers
+from logs import new_request_id, request_id
+from models import database, passengers
+from queries import messages_after, unread_count, unread_counts
 
 ws = APIRouter()
+logger = logging.getLogger(__name__)
 
 
 async def get_number_of_messages_by_user(user_id: int):
-    count = select(func.count(messages.c.id)).where(and_(
-        messages.c.user_id == user_id,
-        messages.c.read == False
-    ))
-    return await database.fetch_val(count)
+    return await unread_count.fetch_val(database, user_id=int(user_id))
 
 
 async def get_passengers_by_route(route_id: int):
@@ -27,66 +29,150 @@ async def get_passengers_by_route(route_id: int):
     return await database.fetch_all(psgs)
 
 
+async def get_messages_after(user_id: int, last_id: int):
+    return await messages_after.fetch_all(database, user_id=user_id, last_id=last_id)
+
+
 class ConnectionManager:
+    # Clients connected with ?v=2 get typed JSON events:
+    #   {"type": "unread", "count": 3}
+    #   {"type": "message", "message": {...messages row...}}
+    #   {"type": "match", "route": {...}}
+    # everyone else keeps getting the bare unread count as text.
     def __init__(self):
         self.active_connections: Dict[WebSocket] = {}
+        self.typed = set()
         
-    async def connect(self, websocket: WebSocket, client_id: str):
+    async def connect(self, websocket: WebSocket, client_id: str, typed: bool = False, last_id: Optional[int] = None):
         await websocket.accept()
-        self.active_connections[f"client_id_{client_id}"] = websocket
+        key = f"client_id_{client_id}"
+        self.active_connections[key] = websocket
+        if typed:
+            self.typed.add(key)
+        else:
+            self.typed.discard(key)
+        if typed and last_id is not None:
+            await self.resume(websocket, client_id, last_id)
         nom = await get_number_of_messages_by_user(client_id)
-        await websocket.send_text(str(nom))
+        await self.send_count(key, websocket, nom)
+
+    async def disconnect(self, client_id: int, websocket: Optional[WebSocket] = None):
+        # a reconnect may already have replaced the socket under this key
+        key = f"client_id_{client_id}"
+        if websocket is not None and self.active_connections.get(key) is not websocket:
+            return
+        self.active_connections.pop(key, None)
+        self.typed.discard(key)
+
+    async def send_count(self, key: str, websocket: WebSocket, count: int):
+        if key in self.typed:
+            await websocket.send_json({"type": "unread", "count": count})
+        else:
+            await websocket.send_text(str(count))
 
-    async def disconnect(self, client_id: int):
-        del self.active_connections[f"client_id_{client_id}"]
+    async def resume(self, websocket: WebSocket, client_id: int, last_id: int):
+        # everything written while the client was away, oldest first
+        for row in await get_messages_after(int(client_id), last_id):
+            await websocket.send_json({"type": "message", "message": jsonable_encoder(dict(row))})
+
+    async def push_messages(self, rows: list):
+        # called right after messages are written, typed clients get the rows
+        # and legacy clients the new unread count
+        legacy = []
+        sends = []
+        for row in rows:
+            key = f"client_id_{row['user_id']}"
+            websocket = self.active_connections.get(key)
+            if websocket is None:
+                continue
+            if key in self.typed:
+                sends.append(websocket.send_json({"type": "message", "message": jsonable_encoder(dict(row))}))
+            else:
+                legacy.append(row["user_id"])
+        await asyncio.gather(*sends, return_exceptions=True)
+        if legacy:
+            await self.send_number_messages_by_users(legacy)
 
     async def send_personal_message(self, client_id: int, message: str):
         try:
             ws = self.active_connections[f"client_id_{client_id}"]
         except KeyError:
-            print(f"User #{client_id} not found")
+            logger.debug("user not connected", extra={"user_id": client_id, "sample": 100})
+            return
         await ws.send_text(message)
     
     async def send_number_messages_by_user(self, client_id: int):
         try:
             ws = self.active_connections[f"client_id_{client_id}"]
             count = await get_number_of_messages_by_user(client_id)
-            await ws.send_text(str(count))
+            await self.send_count(f"client_id_{client_id}", ws, count)
         except KeyError:
-            print(f"User #{client_id} not found")
+            logger.debug("user not connected", extra={"user_id": client_id, "sample": 100})
     
+    async def send_event(self, client_id: int, event: dict):
+        key = f"client_id_{client_id}"
+        if key in self.typed:
+            await self.active_connections[key].send_json(event)
+
+    async def send_number_messages_by_users(self, user_ids: list):
+        # one count query for every connected user, then send concurrently
+        connected = {int(u) for u in user_ids if f"client_id_{u}" in self.active_connections}
+        if not connected:
+            return
+        rows = await unread_counts.fetch_all(database, user_ids=list(connected))
+        counts = {row["user_id"]: row["count"] for row in rows}
+        sockets = {u: self.active_connections.get(f"client_id_{u}") for u in connected}
+        await asyncio.gather(*[
+            self.send_count(f"client_id_{u}", websocket, counts.get(u, 0))
+            for u, websocket in sockets.items() if websocket is not None
+        ], return_exceptions=True)
+
     async def send_number_of_message_all_users_by_route(self, psgs: list):
         for s in psgs:
             user_id = dict(s).get("user_id")
             for k, v in self.active_connections.items():
                 if k == f"client_id_{user_id}":
                     nom = await get_number_of_messages_by_user(int(user_id))
-                    await v.send_text(str(nom))
+                    await self.send_count(k, v, nom)
 
 
 manager = ConnectionManager()
 
 
 @ws.websocket("/ws/{token}")
-async def websocket_endpoint(websocket: WebSocket, token: str):
+async def websocket_endpoint(websocket: WebSocket, token: str, v: int = 1, last_id: Optional[int] = None):
+    request_id.set(new_request_id())
     try:
         payload = jwt.decode(token, os.environ["SECRET_KEY"], algorithms=[ALGORITHM])
         client_id: int = payload.get("id")
     except JWTError:
-        print("JWTError")
-    await manager.connect(websocket, client_id)
-    print(manager.active_connections)
+        logger.info("websocket token rejected")
+        await websocket.close(code=1008)
+        return
     try:
+        await manager.connect(websocket, client_id, typed=v >= 2, last_id=last_id)
+        logger.info("websocket connected", extra={
+            "user_id": client_id, "connections": len(manager.active_connections), "sample": 100
+        })
         while True:
-            data = await websocket.receive_json()
-            type = data["type"]
-            if type == "get_number":
-                reciever_id = int(data["id"])
-                await manager.send_number_messages_by_user(reciever_id)
-            elif type == "read_messages":
-                nom = await get_number_of_messages_by_user(client_id)
-                await websocket.send_text(str(nom))
-            else:
-                print("Case not found")
+            try:
+                # a binary frame fails with KeyError, text that isn't JSON
+                # with ValueError
+                data = await websocket.receive_json()
+                type = data["type"]
+                if type == "get_number":
+                    reciever_id = int(data["id"])
+                    await manager.send_number_messages_by_user(reciever_id)
+                elif type == "read_messages":
+                    nom = await get_number_of_messages_by_user(client_id)
+                    await manager.send_count(f"client_id_{client_id}", websocket, nom)
+                elif type == "resume":
+                    await manager.resume(websocket, client_id, int(data["last_id"]))
+                else:
+                    logger.warning("unknown websocket message type", extra={"user_id": client_id, "type": type})
+            except (KeyError, TypeError, ValueError):
+                logger.warning("malformed websocket message", extra={"user_id": client_id})
     except WebSocketDisconnect:
-        await manager.disconnect(client_id)
+        pass
+    finally:
+        await manager.disconnect(client_id, websocket)